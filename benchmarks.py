@@ -0,0 +1,138 @@
+"""
+    Benchmarks for UnifiedPaginator.page(), using the in-memory object manager
+    so they run without the App Engine SDK:
+
+        python -m potatopage.benchmarks [--items 5000] [--latency 0.002]
+
+    Every scenario starts from an empty cache and reports the averages per
+    page() call: wall time, datastore queries, entities fetched vs. entities
+    returned, keys read by keys only queries and cache operations.
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import time
+from collections import Counter
+
+
+PATTERNS = ("sequential", "random", "deep")
+
+VARIANTS = {
+    "default": {},
+    "batch_cache": {"batch_cache_timeout": 60},
+    "page_cursors": {"page_cursors": True},
+    "no_cursors": {"cursors": False},
+    "key_list": {"cursors": False, "key_list_timeout": 60},
+}
+
+
+class CountingCache(object):
+    """
+        Wraps a Django cache backend and counts the calls made to it.
+    """
+    OPERATIONS = ("get", "get_many", "set", "set_many", "add", "delete", "delete_many", "incr")
+
+    def __init__(self, backend):
+        self._backend = backend
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name not in self.OPERATIONS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+
+def page_numbers(pattern, num_pages, count, seed=0):
+    """ The 1-based page numbers a scenario visits """
+    rand = random.Random(seed)
+    if pattern == "sequential":
+        return range(1, min(count, num_pages) + 1)
+    if pattern == "random":
+        return [rand.randint(1, num_pages) for i in range(count)]
+    if pattern == "deep":
+        return [rand.randint(num_pages // 2, num_pages) for i in range(count)]
+    raise ValueError("Unknown access pattern: %s" % pattern)
+
+
+def run_scenario(pattern, items, per_page, batch_size, pages, latency=0, **paginator_kwargs):
+    """ Runs one scenario and returns a dict of per page() averages """
+    from django.core.cache import cache
+
+    from . import paginator as paginator_module
+    from .object_managers.in_memory import InMemoryObjectManager
+
+    counting_cache = CountingCache(cache)
+    original_cache, paginator_module.cache = paginator_module.cache, counting_cache
+    try:
+        manager = InMemoryObjectManager(range(items), latency=latency, cursors=paginator_kwargs.pop("cursors", True))
+        paginator = paginator_module.UnifiedPaginator(manager, per_page, batch_size=batch_size, **paginator_kwargs)
+        num_pages = (items + per_page - 1) // per_page
+
+        numbers = page_numbers(pattern, num_pages, pages)
+        returned = 0
+        start = time.time()
+        for number in numbers:
+            returned += len(paginator.page(number).object_list)
+        elapsed = time.time() - start
+    finally:
+        paginator_module.cache = original_cache
+        cache.clear()
+
+    calls = float(len(numbers))
+    return {
+        "ms": elapsed * 1000 / calls,
+        "queries": manager.queries / calls,
+        "fetched": manager.rows_fetched / calls,
+        "returned": returned / calls,
+        "keys": manager.keys_fetched / calls,
+        "cache_ops": counting_cache.total / calls,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--pages", type=int, default=50, help="page() calls per scenario")
+    parser.add_argument("--latency", type=float, default=0, help="simulated seconds per query")
+    parser.add_argument("--per-page", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--variant", choices=sorted(VARIANTS), nargs="+", default=sorted(VARIANTS))
+    args = parser.parse_args(argv)
+
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        })
+        import django
+        if hasattr(django, "setup"):
+            django.setup()
+
+    columns = ("ms", "queries", "fetched", "returned", "keys", "cache_ops")
+    print("%-12s %-12s %8s %6s " % ("variant", "pattern", "per_page", "batch") +
+          " ".join("%9s" % column for column in columns))
+
+    for variant in args.variant:
+        for pattern in PATTERNS:
+            for per_page in args.per_page:
+                for batch_size in args.batch_size:
+                    result = run_scenario(
+                        pattern, args.items, per_page, batch_size, args.pages,
+                        latency=args.latency, **VARIANTS[variant]
+                    )
+                    print("%-12s %-12s %8d %6d " % (variant, pattern, per_page, batch_size) +
+                          " ".join("%9.2f" % result[column] for column in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+    Keeps the cursors of watched paginators up to date as their models change.
+
+    watch() a paginator (with track_changes on) once, e.g. at import time, and
+    every change to its model then calls its object_changed(). Django models
+    are hooked up through the pre_save, post_save and post_delete signals,
+    NDB models need the object_managers.ndb_api.WatchedModel mixin.
+
+    Changes made without going through the model (bulk updates, deletes of
+    querysets, other processes not importing the watch() calls) aren't seen,
+    flush_model_cache() is still needed for those.
+
+    Paginators are only watched as long as something else keeps them alive.
+"""
+import threading
+import weakref
+
+from .utils import model_cache_key
+
+# model cache key -> [(weak reference to the paginator, matches), ...]
+_watched = {}
+_watched_lock = threading.Lock()
+_signals_connected = False
+
+
+def watch(paginator, matches=None):
+    """
+        Calls paginator.object_changed() whenever an object of its model is
+        saved or deleted. matches(obj) tells whether an object belongs to the
+        paginator's query. Without it every object of the model is taken to,
+        which still keeps the cursors correct, just not as many of them.
+    """
+    model_key = paginator.object_list.model_cache_key
+    if not model_key:
+        raise ValueError("%s isn't a query on a single model" % paginator.object_list.__class__.__name__)
+
+    _connect_signals()
+    with _watched_lock:
+        # Forgets the paginators of the model which are gone on the way
+        watchers = [watcher for watcher in _watched.get(model_key, ()) if watcher[0]() is not None]
+        _watched[model_key] = watchers + [(weakref.ref(paginator), matches)]
+
+
+def unwatch(paginator):
+    with _watched_lock:
+        for model_key, watchers in _watched.items():
+            watchers[:] = [watcher for watcher in watchers if watcher[0]() not in (None, paginator)]
+            if not watchers:
+                del _watched[model_key]
+
+
+def _live_watchers(model_key):
+    """ The (paginator, matches) watching the model which are still alive """
+    with _watched_lock:
+        watchers = [(ref(), matches) for ref, matches in _watched.get(model_key, ())]
+    return [(paginator, matches) for paginator, matches in watchers if paginator is not None]
+
+
+def is_watched(model):
+    """ Whether any paginator watches the given model (class, instance or kind) """
+    return bool(_live_watchers(model_cache_key(model)))
+
+
+def object_changed(old_object, new_object):
+    """
+        Tells the paginators watching the model that an object changed from
+        old_object (None if it was added) to new_object (None if it was
+        deleted).
+    """
+    obj = new_object if new_object is not None else old_object
+    if obj is None:
+        return
+
+    for paginator, matches in _live_watchers(model_cache_key(obj)):
+        manager = paginator.object_list
+        old_key, new_key = None, None
+        if old_object is not None and (matches is None or matches(old_object)):
+            old_key = manager.sort_key(old_object)
+        if new_object is not None and (matches is None or matches(new_object)):
+            new_key = manager.sort_key(new_object)
+        # A copy, the watched paginator may be serving a page meanwhile
+        paginator._detached_copy().object_changed(old_key, new_key)
+
+
+def _pre_save(sender, instance, raw=False, **kwargs):
+    if raw or not is_watched(sender):
+        return
+
+    instance._watched_previous = None
+    if instance.pk is not None:
+        try:
+            instance._watched_previous = sender._default_manager.get(pk=instance.pk)
+        except sender.DoesNotExist:
+            pass
+
+
+def _post_save(sender, instance, created=False, raw=False, **kwargs):
+    if raw or not is_watched(sender):
+        return
+    previous = None if created else getattr(instance, "_watched_previous", None)
+    instance._watched_previous = None
+    object_changed(previous, instance)
+
+
+def _post_delete(sender, instance, **kwargs):
+    if is_watched(sender):
+        object_changed(instance, None)
+
+
+def _connect_signals():
+    global _signals_connected
+    if _signals_connected:
+        return
+
+    from django.db.models.signals import post_delete, post_save, pre_save
+    pre_save.connect(_pre_save, dispatch_uid="potatopage_watch_pre_save")
+    post_save.connect(_post_save, dispatch_uid="potatopage_watch_post_save")
+    post_delete.connect(_post_delete, dispatch_uid="potatopage_watch_post_delete")
+    _signals_connected = True
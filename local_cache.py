@@ -0,0 +1,55 @@
+import cPickle as pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+        A bounded, in-process LRU cache with a timeout per entry. Paginators
+        with local_cache_timeout set use it as a first tier in front of the
+        shared Django cache.
+
+        Values are stored pickled, like in the shared cache, so every caller
+        gets its own copy and no request or thread can change what another
+        one reads.
+    """
+    def __init__(self, max_items=1000):
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is None or entry[0] < now:
+                    continue
+                # Back to the most recently used end
+                self._entries[key] = entry
+                found[key] = entry[1]
+        return dict((key, pickle.loads(value)) for key, value in found.items())
+
+    def set_many(self, values, timeout):
+        expires = time.time() + timeout
+        values = dict((key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in values.items())
+        with self._lock:
+            for key, value in values.items():
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cache = LocalCache()
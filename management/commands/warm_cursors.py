@@ -0,0 +1,56 @@
+import importlib
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from potatopage.warmer import warm_cursors
+
+
+def _import_callable(path):
+    module_path, _, name = path.rpartition(".")
+    try:
+        return getattr(importlib.import_module(module_path), name)
+    except (ValueError, ImportError, AttributeError) as e:
+        raise CommandError("Can't import %s: %s" % (path, e))
+
+
+class Command(BaseCommand):
+    help = (
+        "Caches the cursors of a paginated query ahead of time. Takes the dotted "
+        "path of a callable which returns the paginator to warm."
+    )
+    args = "<paginator>"
+
+    if django.VERSION < (1, 8):
+        # Django 1.8+ calls add_arguments() instead
+        option_list = BaseCommand.option_list + (
+            make_option("--max-batches", type="int", dest="max_batches", default=None),
+            make_option("--rate-limit", type="float", dest="rate_limit", default=None, help="queries per second"),
+            make_option("--batches-per-query", type="int", dest="batches_per_query", default=20),
+            make_option("--tail-only", action="store_true", dest="tail_only", default=False),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paginator", help="e.g. myapp.listings.latest_posts_paginator")
+        parser.add_argument("--max-batches", type=int, default=None)
+        parser.add_argument("--rate-limit", type=float, default=None, help="queries per second")
+        parser.add_argument("--batches-per-query", type=int, default=20)
+        parser.add_argument("--tail-only", action="store_true", default=False)
+
+    def handle(self, *args, **options):
+        path = options.get("paginator") or (args[0] if args else None)
+        if not path:
+            raise CommandError("Give the dotted path of a callable which returns the paginator")
+        paginator = _import_callable(path)()
+
+        result = warm_cursors(
+            paginator,
+            max_batches=options["max_batches"],
+            rate_limit=options["rate_limit"],
+            tail_only=options["tail_only"],
+            batches_per_query=options["batches_per_query"],
+        )
+        self.stdout.write("Warmed %(batches)d batches with %(queries)d queries" % result)
+        if not result["complete"]:
+            self.stdout.write("The end of the query wasn't reached, run again to continue")
@@ -1,9 +1,21 @@
+import copy
+
+from ..utils import background_pool
+
+
 class ObjectManager(object):
     """
     This is a base object manager making sure all sub-classes implement the
     right methods and properties.
     """
     supports_cursors = None
+    # Whether reversed() can return a manager for the reversed query
+    supports_reverse = False
+    # Whether fetch_keys() and get_by_keys() are implemented
+    supports_key_lists = False
+    # Set by the paginator if it wants page_cursors collected every
+    # cursor_step objects
+    cursor_step = None
 
     @property
     def cache_key(self):
@@ -13,6 +25,14 @@ class ObjectManager(object):
         """
         raise NotImplemented()
 
+    @property
+    def model_cache_key(self):
+        """
+        Returns the key shared by all queries on the same model, so their
+        cached cursors can be invalidated at once. None if there is no model.
+        """
+        return None
+
     def starting_cursor(self, cursor):
         """
         This method should be used to set a cursor/token before actually doing
@@ -30,6 +50,106 @@ class ObjectManager(object):
         if self.supports_cursors:
             raise NotImplemented()
 
+    def skip_ahead(self, count, start_cursor=None):
+        """
+        Skips count objects, starting at start_cursor or at the beginning of
+        the query, using the cheapest (keys only) query the backend has.
+
+        Returns the cursor after the skipped objects or None if the query
+        doesn't contain that many objects.
+        """
+        if self.supports_cursors:
+            raise NotImplementedError()
+
+    def cursors_ahead(self, step, count, start_cursor=None):
+        """
+        Walks forward from start_cursor (or the beginning of the query) and
+        returns the cursors after every step objects, at most count of them.
+        Fewer cursors are returned if the query runs out of objects.
+
+        Backends which can read cursors in the middle of a query should
+        override this to do the whole walk with a single keys only query.
+        """
+        cursors = []
+        cursor = start_cursor
+        for i in range(count):
+            cursor = self.skip_ahead(step, start_cursor=cursor)
+            if cursor is None:
+                break
+            cursors.append(cursor)
+        return cursors
+
+    def cursors_ahead_queries(self, count, found):
+        """
+        Returns how many queries cursors_ahead() made when asked for count
+        cursors and found that many. Overrides which walk with a single query
+        should return 1.
+        """
+        return min(count, found + 1)
+
+    @property
+    def more_objects(self):
+        """
+        Returns whether the last query found more objects after its end (e.g.
+        by reading one object more than asked for), or None if it can't tell.
+        If it can't, the paginator falls back to contains_more_objects().
+        """
+        return None
+
+    @property
+    def page_cursors(self):
+        """
+        Returns the cursors after every cursor_step objects of the last query,
+        if cursor_step is set and the backend can read cursors in the middle of
+        a query. Otherwise an empty list.
+        """
+        return []
+
+    def reversed(self):
+        """
+        Returns a new object manager for the same query in reverse order
+        (including reversed tie breaks, so it returns exactly the same objects
+        backwards). Only called if supports_reverse is True.
+        """
+        raise NotImplementedError()
+
+    def count_from(self, start_cursor=None, limit=None):
+        """
+        Returns the number of objects after start_cursor (or from the start),
+        but at most limit. This reads them in chunks, subclasses should count
+        with a keys only or count query instead.
+        """
+        count = 0
+        cursor = start_cursor
+        while limit is None or count < limit:
+            step = 1000 if limit is None else min(1000, limit - count)
+            if self.supports_cursors:
+                if cursor:
+                    self.starting_cursor(cursor)
+                read = len(self[:step])
+                cursor = self.next_cursor
+            else:
+                read = len(self[count:count + step])
+
+            count += read
+            if read < step:
+                break
+        return count
+
+    def fetch_keys(self, limit):
+        """
+        Returns the keys of the first limit objects in order, read with a
+        keys only query. Only called if supports_key_lists is True.
+        """
+        raise NotImplementedError()
+
+    def get_by_keys(self, keys):
+        """
+        Returns the objects with the given keys in the same order, leaving out
+        the ones that don't exist anymore.
+        """
+        raise NotImplementedError()
+
     def __getitem__(self, value):
         """
         Doing the actual query to the given backend (DB, API, etc.), caching the
@@ -39,6 +159,38 @@ class ObjectManager(object):
         """
         raise NotImplemented()
 
+    def fetch_async(self, count, start_cursor=None):
+        """
+        Starts reading count objects from start_cursor (or the beginning of the
+        query) in the background.
+
+        Returns a future whose get_result() gives an (objects, end cursor,
+        more objects) tuple, or None if the work couldn't be started. The default runs the
+        query on a copy of this manager in the shared background thread pool.
+        """
+        def fetch():
+            manager = copy.copy(self)
+            if start_cursor:
+                manager.starting_cursor(start_cursor)
+            return manager[:count], manager.next_cursor, manager.more_objects
+
+        return background_pool.try_submit(fetch)
+
+    def cacheable_results(self, results):
+        """
+        Returns the results of a batch query in a form that can be pickled
+        into the batch cache.
+        """
+        return list(results)
+
+    def sort_key(self, obj):
+        """
+        Returns a value which orders obj like the query does (ties broken by
+        the key, like reversed() does), or None if the backend can't tell.
+        Used to find the cursors a change to obj moves.
+        """
+        return None
+
     def contains_more_objects(self, next_batch_cursor):
         """
         Makes another query to check if there are any more objects available
@@ -1,7 +1,75 @@
 from djangoappengine.db.utils import set_cursor, get_cursor
 
-from ..utils import supports_cursor
+from django.db.models.sql.where import WhereNode
+
+from ..utils import hashed_cache_key, model_cache_key, supports_cursor
 from .base import ObjectManager
+from .merged import MergedObjectManager, ordering_comparator, ordering_key
+
+
+def canonical_where(node):
+    """
+        Returns a string for a where tree which is the same for equivalent
+        filters, whatever order they were added in. str() of a where tree
+        isn't usable as it contains the memory addresses of its constraints.
+    """
+    if isinstance(node, WhereNode):
+        children = ", ".join(sorted(canonical_where(child) for child in node.children))
+        result = "(%s: %s)" % (node.connector, children)
+        return "(NOT %s)" % result if node.negated else result
+
+    if not isinstance(node, tuple) and not hasattr(node, "lookup_name"):
+        # Not a lookup: NothingNode from none(), ExtraWhere from extra(where=...)
+        return "%s(%r, %r)" % (node.__class__.__name__, getattr(node, "sqls", None), getattr(node, "params", None))
+
+    if isinstance(node, tuple):
+        # Django < 1.7: (Constraint, lookup_type, annotation, value)
+        constraint, lookup_type, annotation, value = node
+        column = "%s.%s" % (constraint.alias, constraint.col)
+    else:
+        # Lookup objects
+        lookup_type, value = node.lookup_name, node.rhs
+        column = getattr(getattr(node.lhs, "target", None), "column", node.lhs)
+
+    if isinstance(value, (list, tuple, set, frozenset, xrange)):
+        value = sorted(value)
+    return "%s__%s=%r" % (column, lookup_type, value)
+
+
+def total_ordering(queryset):
+    """ The ordering of the queryset with the pk added as a tie break """
+    ordering = list(queryset.query.order_by)
+    if "pk" not in ordering and "-pk" not in ordering:
+        ordering.append("pk")
+    return ordering
+
+
+def merged_in_query(queryset, field, values):
+    """
+        Returns an object manager for queryset.filter(<field>__in=values) which
+        supports cursors, by merging one query per value.
+    """
+    ordering = total_ordering(queryset)
+    managers = [
+        DjangoNonrelManager(queryset.filter(**{field: value}).order_by(*ordering))
+        for value in set(values)
+    ]
+    return MergedObjectManager(managers, ordering_comparator(ordering), model_cache_key(queryset.model))
+
+
+def merged_exclude_query(queryset, field, value):
+    """
+        Returns an object manager for queryset.exclude(<field>=value) which
+        supports cursors, by merging a <field> < value and a <field> > value
+        query. Like for the exclude itself, the datastore needs the queryset
+        to be ordered by field first.
+    """
+    ordering = total_ordering(queryset)
+    managers = [
+        DjangoNonrelManager(queryset.filter(**{field + "__lt": value}).order_by(*ordering)),
+        DjangoNonrelManager(queryset.filter(**{field + "__gt": value}).order_by(*ordering)),
+    ]
+    return MergedObjectManager(managers, ordering_comparator(ordering), model_cache_key(queryset.model))
 
 
 class DjangoNonrelManager(ObjectManager):
@@ -14,21 +82,33 @@ class DjangoNonrelManager(ObjectManager):
     def __init__(self, queryset):
         self.queryset = queryset
         self.supports_cursors = supports_cursor(queryset)
+        self.supports_reverse = self.supports_cursors and bool(queryset.query.order_by)
+        self.supports_key_lists = True
         self._start_cursor = None
         self._latest_cursor = None
+        self._more_objects = None
+        self._cache_key = None
 
     @property
     def cache_key(self):
         """
             Returns a key that can be used to cache this particular object manager.
-            I.e. a unique string for the given queryset.
+            I.e. a unique string for the given queryset. Computed only once.
         """
-        return " ".join([
-            str(self.queryset.query.where),
-            str(self.queryset.query.order_by),
-            str(self.queryset.query.low_mark),
-            str(self.queryset.query.high_mark)
-        ]).replace(" ", "_")
+        if self._cache_key is None:
+            query = self.queryset.query
+            self._cache_key = hashed_cache_key(
+                self.model_cache_key,
+                canonical_where(query.where),
+                [str(order) for order in query.order_by],
+                query.low_mark,
+                query.high_mark
+            )
+        return self._cache_key
+
+    @property
+    def model_cache_key(self):
+        return model_cache_key(self.queryset.model)
 
     def starting_cursor(self, cursor):
         """
@@ -37,6 +117,7 @@ class DjangoNonrelManager(ObjectManager):
         """
         self._start_cursor = cursor
         self._latest_cursor = None
+        self._more_objects = None
 
     @property
     def next_cursor(self):
@@ -45,17 +126,91 @@ class DjangoNonrelManager(ObjectManager):
         """
         return self._latest_cursor
 
+    @property
+    def more_objects(self):
+        """
+            Returns whether the last query found more objects after its end,
+            or None if it couldn't tell.
+        """
+        return self._more_objects
+
+    def skip_ahead(self, count, start_cursor=None):
+        """
+            Skips count objects with a keys only query and returns the cursor
+            after them, or None if there aren't enough objects.
+        """
+        query = self.queryset.all().values_list('pk')[:count]
+        if start_cursor:
+            query = set_cursor(query, start=start_cursor)
+
+        if len(list(query)) < count:
+            return None
+
+        try:
+            return get_cursor(query)
+        except TypeError:
+            return None
+
+    def count_from(self, start_cursor=None, limit=None):
+        query = self.queryset.all()
+        if limit:
+            query = query[:limit]
+        if start_cursor:
+            query = set_cursor(query, start=start_cursor)
+        return query.count()
+
+    def fetch_keys(self, limit):
+        return list(self.queryset.all().values_list('pk', flat=True)[:limit])
+
+    def get_by_keys(self, keys):
+        """
+            Reads the objects with a batch get. Objects that changed since the
+            keys were read aren't checked against the filters again.
+        """
+        objects = self.queryset.model._default_manager.in_bulk(keys)
+        return [objects[key] for key in keys if key in objects]
+
+    def sort_key(self, obj):
+        return ordering_key(obj, total_ordering(self.queryset))
+
+    def reversed(self):
+        """
+            Returns a manager for the queryset in reverse order. The pk is added
+            to the ordering so ties come back in exactly the reverse order too.
+        """
+        return DjangoNonrelManager(self.queryset.order_by(*total_ordering(self.queryset)).reverse())
+
     def __getitem__(self, value):
         """
             Does the query, saves the cursor for the next query to self and
             returns the objects in form of a list.
         """
-        query = self.queryset.all()[value]
+        # The end cursor can only be read after the last object of a query,
+        # so reading one object more to see if there are more only works if
+        # we don't need the cursor.
+        sentinel = not self.supports_cursors and isinstance(value, slice) and value.stop is not None
+        if sentinel:
+            query = self.queryset.all()[value.start:value.stop + 1]
+        else:
+            query = self.queryset.all()[value]
+
         if self._start_cursor:
             query = set_cursor(query, start=self._start_cursor)
             self._start_cursor = None
 
         obj_list = list(query)
+        requested = None
+        if isinstance(value, slice) and value.stop is not None:
+            requested = value.stop - (value.start or 0)
+
+        if sentinel:
+            self._more_objects = len(obj_list) > requested
+            obj_list = obj_list[:requested]
+        elif requested is not None and len(obj_list) < requested:
+            self._more_objects = False
+        else:
+            self._more_objects = None
+
         try:
             self._latest_cursor = get_cursor(query)
         except TypeError:
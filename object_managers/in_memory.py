@@ -0,0 +1,189 @@
+import base64
+import bisect
+import copy
+import pickle
+import time
+
+from .base import ObjectManager
+
+
+class InMemoryObjectManager(ObjectManager):
+    """
+        Object manager over a plain list of objects. Meant for benchmarks and
+        tests that need to run without the App Engine SDK.
+
+        Cursors behave like datastore cursors: they remember the position of
+        the last object read (by sort key), not an offset, so objects added in
+        front of a cursor don't shift what comes after it.
+
+        latency - Seconds every query sleeps, to simulate datastore RPCs.
+
+        cursors - If False, behaves like a query that can't use cursors.
+
+        The queries, rows_fetched and keys_fetched counters record the work
+        done so far.
+    """
+    supports_cursors = True
+    supports_reverse = True
+    supports_key_lists = True
+
+    def __init__(self, objects, key=None, latency=0, cache_key=None, cursors=True):
+        self.supports_cursors = cursors
+        self.supports_reverse = cursors
+        self._key = key or (lambda obj: obj)
+        self._latency = latency
+        self._cache_key = cache_key or "in_memory_%d" % id(self)
+        # Sorted (sort key, insertion id, object) tuples, and their first two
+        # items on their own for bisecting
+        self._entries = []
+        self._positions = []
+        self._next_id = 0
+        for obj in objects:
+            self.add(obj)
+
+        self._start_cursor = None
+        self._latest_cursor = None
+        self._latest_page_cursors = []
+        self._more_objects = None
+
+        # Reversed copies share the entries and count their work here
+        self._reverse = False
+        self._root = self
+
+        self.queries = 0
+        self.rows_fetched = 0
+        self.keys_fetched = 0
+
+    @property
+    def cache_key(self):
+        return self._cache_key
+
+    def add(self, obj):
+        """ Inserts an object at its sorted position """
+        position = (self._key(obj), self._next_id)
+        index = bisect.bisect_right(self._positions, position)
+        self._positions.insert(index, position)
+        self._entries.insert(index, position + (obj,))
+        self._next_id += 1
+
+    def remove(self, obj):
+        for i, entry in enumerate(self._entries):
+            if entry[2] is obj:
+                del self._entries[i]
+                del self._positions[i]
+                return
+        raise ValueError("%r isn't in the manager" % obj)
+
+    def reversed(self):
+        manager = copy.copy(self)
+        manager._reverse = not self._reverse
+        manager.starting_cursor(None)
+        return manager
+
+    def count_from(self, start_cursor=None, limit=None):
+        self._query()
+        count = len(self._entries) - self._position(start_cursor)
+        if limit is not None:
+            count = min(count, limit)
+        self._root.keys_fetched += count
+        return count
+
+    def fetch_keys(self, limit):
+        self._query()
+        entries = self._ordered_entries()[:limit]
+        self._root.keys_fetched += len(entries)
+        return [entry[1] for entry in entries]
+
+    def get_by_keys(self, keys):
+        self._query()
+        objects = dict((entry[1], entry[2]) for entry in self._entries)
+        results = [objects[key] for key in keys if key in objects]
+        self._root.rows_fetched += len(results)
+        return results
+
+    def sort_key(self, obj):
+        return (self._key(obj),)
+
+    def _ordered_entries(self):
+        return self._entries[::-1] if self._reverse else self._entries
+
+    def _encode_cursor(self, entry):
+        return base64.urlsafe_b64encode(pickle.dumps(entry[:2]))
+
+    def _position(self, cursor):
+        """ Index of the first entry after the cursor """
+        if not cursor:
+            return 0
+        position = pickle.loads(base64.urlsafe_b64decode(str(cursor)))
+        if self._reverse:
+            return len(self._positions) - bisect.bisect_left(self._positions, position)
+        return bisect.bisect_right(self._positions, position)
+
+    def _query(self):
+        self._root.queries += 1
+        if self._latency:
+            time.sleep(self._latency)
+
+    def starting_cursor(self, cursor):
+        self._start_cursor = cursor
+        self._latest_cursor = None
+
+    @property
+    def next_cursor(self):
+        return self._latest_cursor
+
+    @property
+    def page_cursors(self):
+        return self._latest_page_cursors
+
+    @property
+    def more_objects(self):
+        return self._more_objects
+
+    def __getitem__(self, value):
+        if isinstance(value, slice):
+            start, stop = value.start or 0, value.stop
+        else:
+            start, stop = value, value + 1
+
+        self._query()
+        position = self._position(self._start_cursor)
+        self._start_cursor = None
+
+        entries = self._ordered_entries()[position + start:position + stop]
+        self._root.rows_fetched += len(entries)
+        # The datastore skips offsets much like a keys only query
+        self._root.keys_fetched += max(0, min(start, len(self._entries) - position))
+        self._more_objects = position + stop < len(self._entries)
+
+        self._latest_cursor = self._encode_cursor(entries[-1]) if entries else None
+        self._latest_page_cursors = []
+        if self.cursor_step:
+            for i in range(self.cursor_step - 1, len(entries), self.cursor_step):
+                self._latest_page_cursors.append(self._encode_cursor(entries[i]))
+
+        objects = [entry[2] for entry in entries]
+        return objects if isinstance(value, slice) else objects[0]
+
+    def skip_ahead(self, count, start_cursor=None):
+        cursors = self.cursors_ahead(count, 1, start_cursor=start_cursor)
+        return cursors[0] if cursors else None
+
+    def cursors_ahead(self, step, count, start_cursor=None):
+        self._query()
+        position = self._position(start_cursor)
+
+        entries = self._ordered_entries()[position:position + step * count]
+        self._root.keys_fetched += len(entries)
+
+        return [self._encode_cursor(entries[i]) for i in range(step - 1, len(entries), step)]
+
+    def cursors_ahead_queries(self, count, found):
+        return 1
+
+    def contains_more_objects(self, next_batch_cursor):
+        self._query()
+        if self._position(next_batch_cursor) < len(self._entries):
+            self._root.keys_fetched += 1
+            return True
+        return False
@@ -0,0 +1,233 @@
+import base64
+import copy
+import json
+
+from ..utils import Descending, hashed_cache_key
+from .base import ObjectManager
+
+
+def _attribute(obj, name):
+    for part in name.split("__"):
+        obj = getattr(obj, part)
+    return obj
+
+
+def ordering_comparator(ordering):
+    """
+        Returns a cmp function which orders objects like the given Django
+        style ordering, e.g. ["-created", "pk"].
+    """
+    fields = [(name.lstrip("-"), name.startswith("-")) for name in ordering]
+
+    def compare(a, b):
+        for name, descending in fields:
+            result = cmp(_attribute(a, name), _attribute(b, name))
+            if result:
+                return -result if descending else result
+        return 0
+    return compare
+
+
+def ordering_key(obj, ordering):
+    """
+        Returns a sort key for obj in the given Django style ordering, which
+        compares like ordering_comparator() does.
+    """
+    return tuple(
+        Descending(_attribute(obj, name[1:])) if name.startswith("-") else _attribute(obj, name)
+        for name in ordering
+    )
+
+
+class _SubQueryReader(object):
+    """
+        Reads one sub-query of a MergedObjectManager. Its position is the
+        number of objects consumed after a cursor of the sub-query.
+    """
+    def __init__(self, manager, cursor, offset):
+        # A copy, so concurrent reads (e.g. prefetches) don't share state
+        self.manager = copy.copy(manager)
+        self.cursor = cursor
+        self.offset = offset
+        self.buffer = []
+        self.index = 0
+        self.buffer_cursor = None
+        self.more = True
+
+    def fill(self, count):
+        """ Reads up to count objects from the current position """
+        if self.cursor:
+            self.manager.starting_cursor(self.cursor)
+        self.buffer = self.manager[self.offset:self.offset + count]
+        self.index = 0
+        self.buffer_cursor = self.manager.next_cursor
+        # Whether there may be more objects after the buffer
+        self.more = len(self.buffer) == count and self.manager.more_objects is not False
+        self.more_objects = self.manager.more_objects
+
+    def exhausted(self):
+        return self.index >= len(self.buffer)
+
+    def head(self):
+        return self.buffer[self.index]
+
+    def take(self):
+        self.index += 1
+        if self.exhausted() and self.buffer_cursor:
+            self.cursor, self.offset = self.buffer_cursor, 0
+            self.buffer, self.index = [], 0
+        else:
+            self.offset += 1
+
+    def position(self, rebase_offset):
+        """ The [cursor, offset] of the next object to read """
+        if self.offset > rebase_offset:
+            cursor = self.manager.skip_ahead(self.offset, start_cursor=self.cursor)
+            if cursor:
+                return [cursor, 0]
+        return [self.cursor, self.offset]
+
+
+class MergedObjectManager(ObjectManager):
+    """
+        Merges several cursor capable object managers, which return objects
+        in the same order, into one ordered, cursor capable query. E.g. one
+        query per value of an __in filter, which the datastore can't give
+        cursors for as a whole (see gae_db.merged_in_query()).
+
+        Reading n objects reads up to n objects from every sub-query and
+        merges them. The cursor is composite: for every sub-query a cursor
+        plus the number of objects read after it.
+
+        compare - A cmp function for the order of the objects, including a
+        tie break (e.g. on the pk). Objects of different sub-queries which
+        compare equal are taken to be the same object and returned once.
+
+        rebase_offset - Once more objects than this were read after a
+        sub-query's cursor, a keys only query skips to a new cursor.
+    """
+    supports_cursors = True
+    rebase_offset = 200
+
+    def __init__(self, managers, compare, cache_key_prefix="merged"):
+        # Always in the same order, for the cache key and the cursors
+        self.managers = sorted(managers, key=lambda manager: manager.cache_key)
+        self.compare = compare
+        self._cache_key_prefix = cache_key_prefix
+        self._cache_key = None
+
+        self._start_cursor = None
+        self._latest_cursor = None
+        self._more_objects = None
+
+    @property
+    def cache_key(self):
+        if self._cache_key is None:
+            self._cache_key = hashed_cache_key(
+                self._cache_key_prefix,
+                *[manager.cache_key for manager in self.managers]
+            )
+        return self._cache_key
+
+    @property
+    def model_cache_key(self):
+        model_keys = set(manager.model_cache_key for manager in self.managers)
+        return model_keys.pop() if len(model_keys) == 1 else None
+
+    def _encode_cursor(self, positions):
+        return base64.urlsafe_b64encode(json.dumps(positions))
+
+    def _decode_cursor(self, cursor):
+        if not cursor:
+            return [[None, 0] for manager in self.managers]
+        positions = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return [[str(cursor) if cursor else None, offset] for cursor, offset in positions]
+
+    def _read(self, cursor, count):
+        """
+            Reads and merges up to count objects after the given composite
+            cursor. Returns the objects, the readers and whether there are more.
+        """
+        readers = [
+            _SubQueryReader(manager, sub_cursor, offset)
+            for manager, (sub_cursor, offset) in zip(self.managers, self._decode_cursor(cursor))
+        ]
+        for reader in readers:
+            reader.fill(count)
+
+        results = []
+        while len(results) < count:
+            for reader in readers:
+                if reader.exhausted() and reader.more:
+                    # Only happens if objects were in several sub-queries
+                    reader.fill(count - len(results))
+
+            heads = [reader for reader in readers if not reader.exhausted()]
+            if not heads:
+                break
+
+            obj = heads[0].head()
+            for reader in heads[1:]:
+                if self.compare(reader.head(), obj) < 0:
+                    obj = reader.head()
+
+            for reader in heads:
+                if self.compare(reader.head(), obj) == 0:
+                    reader.take()
+            results.append(obj)
+
+        if len(results) < count:
+            more_objects = False
+        elif any(not reader.exhausted() or reader.more_objects for reader in readers):
+            more_objects = True
+        elif any(reader.more for reader in readers):
+            more_objects = None
+        else:
+            more_objects = False
+
+        return results, readers, more_objects
+
+    def _cursor_after(self, readers):
+        return self._encode_cursor([reader.position(self.rebase_offset) for reader in readers])
+
+    def starting_cursor(self, cursor):
+        self._start_cursor = cursor
+        self._latest_cursor = None
+        self._more_objects = None
+
+    @property
+    def next_cursor(self):
+        return self._latest_cursor
+
+    @property
+    def more_objects(self):
+        return self._more_objects
+
+    def __getitem__(self, value):
+        if isinstance(value, slice):
+            start, stop = value.start or 0, value.stop
+        else:
+            start, stop = value, value + 1
+
+        results, readers, more_objects = self._read(self._start_cursor, stop)
+        self._start_cursor = None
+        self._latest_cursor = self._cursor_after(readers) if results else None
+        self._more_objects = more_objects
+
+        results = results[start:]
+        return results if isinstance(value, slice) else results[0]
+
+    def skip_ahead(self, count, start_cursor=None):
+        """
+            Returns the cursor after count objects, or None if there aren't
+            enough. Unlike with the datastore's own queries this isn't keys
+            only, the objects are needed to merge them.
+        """
+        results, readers, more_objects = self._read(start_cursor, count)
+        if len(results) < count:
+            return None
+        return self._cursor_after(readers)
+
+    def contains_more_objects(self, next_batch_cursor):
+        results, readers, more_objects = self._read(next_batch_cursor, 1)
+        return bool(results)
@@ -1,37 +1,108 @@
-from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.datastore.datastore_query import CompositeOrder, Cursor, PropertyOrder
+from google.appengine.ext import ndb
 
+from .. import invalidation
+from ..utils import Descending, hashed_cache_key, model_cache_key
 from .base import ObjectManager
 
+# Entities being deleted by a WatchedModel, by key
+_deleting = {}
+
+
+def canonical_filters(node):
+    """
+        Returns a string for a filter tree which is the same for equivalent
+        filters, whatever order they were added in.
+    """
+    if isinstance(node, (ndb.ConjunctionNode, ndb.DisjunctionNode)):
+        children = ", ".join(sorted(canonical_filters(child) for child in node))
+        return "%s(%s)" % (node.__class__.__name__, children)
+    return str(node)
+
+
+def _order_value(entity, prop):
+    """ The value of an entity that a query order on prop sorts by """
+    if prop == "__key__":
+        return entity.key
+    if prop in entity._properties:
+        return entity._properties[prop]._get_value(entity)
+    # A property of a structured property
+    for name in prop.split("."):
+        entity = getattr(entity, name)
+    return entity
+
+
+class LazyEntityList(object):
+    """
+        The result of a keys only batch query. Behaves like the list of
+        entities, but only the entities that are actually sliced out of it are
+        loaded, with a single ndb.get_multi() (so through NDB's context cache
+        and memcache). Pickles as just the keys, for the batch cache.
+
+        Entities deleted since the keys were queried are left out.
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, value):
+        if isinstance(value, slice):
+            return [entity for entity in ndb.get_multi(self.keys[value]) if entity is not None]
+        return self.keys[value].get()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __repr__(self):
+        return '<LazyEntityList %r>' % self.keys
+
 
 class GaeNdbModelManager(ObjectManager):
     """
         An object manager for ndb models.
 
+        keys_only - Batch queries only fetch keys, which is much cheaper than
+        fetching entities. The entities of the page that is actually returned
+        are loaded with ndb.get_multi().
+
         TODO: Writing some manager specific tests. Currently we always just test
               the paginator itself.
     """
     supports_cursors = True
+    supports_reverse = True
 
-    def __init__(self, query):
+    def __init__(self, query, keys_only=False):
         self.query = query
+        self.keys_only = keys_only
         self._starting_cursor = None
         self._contians_more_entities = None
         self._latest_end_cursor = None
+        self._latest_page_cursors = []
+        self._cache_key = None
 
     @property
     def cache_key(self):
         """
             Returns a key that can be used to cache this particular object manager.
-            I.e. a unique string for the given query.
+            I.e. a unique string for the given query. Computed only once.
         """
-        return " ".join([
-            str(self.query._Query__kind),
-            str(self.query._Query__ancestor),
-            str(self.query._Query__filters),
-            str(self.query._Query__orders),
-            str(self.query._Query__app),
-            str(self.query._Query__namespace)
-        ]).replace(" ", "_")
+        if self._cache_key is None:
+            self._cache_key = hashed_cache_key(
+                self.query.kind,
+                str(self.query.ancestor),
+                canonical_filters(self.query.filters),
+                str(self.query.orders),
+                str(getattr(self.query, "projection", None)),
+                str(self.query.app),
+                str(self.query.namespace)
+            )
+        return self._cache_key
+
+    @property
+    def model_cache_key(self):
+        return model_cache_key(self.query.kind)
 
     def starting_cursor(self, cursor):
         """
@@ -42,6 +113,7 @@ class GaeNdbModelManager(ObjectManager):
         # we need to set those to None, otherwise a second query with the same
         # paginator would fail as the cursors are already set.
         self._latest_end_cursor = None
+        self._latest_page_cursors = []
         self._contians_more_entities = None
 
 
@@ -52,6 +124,98 @@ class GaeNdbModelManager(ObjectManager):
         """
         return self._latest_end_cursor
 
+    @property
+    def more_objects(self):
+        """
+            Returns whether the last query found more entities after its end.
+        """
+        return self._contians_more_entities
+
+    @property
+    def page_cursors(self):
+        """
+            Returns the cursors after every cursor_step entities of the last query.
+        """
+        return self._latest_page_cursors
+
+    def skip_ahead(self, count, start_cursor=None):
+        """
+            Skips count entities with a keys only query and returns the cursor
+            after them, or None if there aren't enough entities.
+        """
+        if start_cursor is not None:
+            start_cursor = Cursor(urlsafe=start_cursor)
+
+        keys, cursor, more = self.query.fetch_page(
+            count,
+            start_cursor=start_cursor,
+            keys_only=True
+        )
+
+        if len(keys) < count or cursor is None:
+            return None
+        return cursor.urlsafe()
+
+    def cursors_ahead(self, step, count, start_cursor=None):
+        """
+            Walks forward with a single keys only query, collecting the cursor
+            after every step entities.
+        """
+        if start_cursor is not None:
+            start_cursor = Cursor(urlsafe=start_cursor)
+
+        iterator = self.query.iter(
+            limit=step * count,
+            start_cursor=start_cursor,
+            keys_only=True,
+            produce_cursors=True
+        )
+
+        cursors = []
+        for i, key in enumerate(iterator):
+            if (i + 1) % step == 0:
+                cursors.append(iterator.cursor_after().urlsafe())
+        return cursors
+
+    def cursors_ahead_queries(self, count, found):
+        return 1
+
+    def count_from(self, start_cursor=None, limit=None):
+        if start_cursor is not None:
+            start_cursor = Cursor(urlsafe=start_cursor)
+        return self.query.count(limit=limit, start_cursor=start_cursor)
+
+    def _total_orders(self):
+        """ The orders of the query with the key added as a tie break """
+        orders = self.query.orders
+        order_list = []
+        if orders is not None:
+            order_list = list(orders.orders) if isinstance(orders, CompositeOrder) else [orders]
+        if not any(getattr(order, "prop", None) == "__key__" for order in order_list):
+            order_list.append(PropertyOrder("__key__"))
+        return order_list
+
+    def reversed(self):
+        """
+            Returns a manager for the query in reverse order. The key is added
+            to the orders so ties come back in exactly the reverse order too.
+        """
+        options = {}
+        if getattr(self.query, "projection", None):
+            options["projection"] = self.query.projection
+
+        query = ndb.Query(
+            kind=self.query.kind,
+            ancestor=self.query.ancestor,
+            filters=self.query.filters,
+            orders=CompositeOrder(self._total_orders()).reversed(),
+            app=self.query.app,
+            namespace=self.query.namespace,
+            default_options=self.query.default_options,
+            **options
+        )
+        return GaeNdbModelManager(query, keys_only=self.keys_only)
+
     def __getitem__(self, value):
         """
             Does the query, saves the cursor for the next query to self and
@@ -63,24 +227,92 @@ class GaeNdbModelManager(ObjectManager):
         if isinstance(value, int):
             max_items = value
 
-        entities, cursor, more = self.query.fetch_page(
-            max_items,
-            start_cursor=self._starting_cursor
+        # Same as fetch_page(), but with an iterator so we can read the
+        # cursors in the middle of the batch as well. The one extra entity we
+        # allow the iterator tells us exactly whether there is more.
+        iterator = self.query.iter(
+            limit=max_items + 1,
+            start_cursor=self._starting_cursor,
+            keys_only=self.keys_only,
+            produce_cursors=True
         )
 
+        entities = []
+        page_cursors = []
+        while len(entities) < max_items and iterator.has_next():
+            entities.append(iterator.next())
+            if self.cursor_step and len(entities) % self.cursor_step == 0:
+                page_cursors.append(iterator.cursor_after().urlsafe())
+
         self._starting_cursor = None
-        if cursor is not None:
-            self._latest_end_cursor = cursor.urlsafe()
-        self._contians_more_entities = more
+        self._latest_page_cursors = page_cursors
+        self._latest_end_cursor = iterator.cursor_after().urlsafe() if entities else None
+        self._contians_more_entities = bool(entities) and iterator.has_next()
 
+        if self.keys_only:
+            # Only the keys are sliced, the paginator loads the page it returns
+            if isinstance(value, slice):
+                return LazyEntityList(entities[value])
+            return entities[value].get()
         return entities[value]
 
+    def fetch_async(self, count, start_cursor=None):
+        """
+            Starts fetching count entities and returns the future, which resolves
+            to an (entities, end cursor, more entities) tuple. Like every NDB future it is
+            only guaranteed to complete if the request waits for it, e.g. by
+            being wrapped in ndb.toplevel.
+        """
+        if start_cursor is not None:
+            start_cursor = Cursor(urlsafe=start_cursor)
+
+        @ndb.tasklet
+        def fetch():
+            # Like __getitem__(), the one extra entity the iterator is allowed
+            # tells exactly whether there is more. fetch_page_async() only
+            # guesses, which would be cached as the end of the query.
+            iterator = self.query.iter(
+                limit=count + 1,
+                start_cursor=start_cursor,
+                keys_only=self.keys_only,
+                produce_cursors=True
+            )
+
+            entities = []
+            more = yield iterator.has_next_async()
+            while more and len(entities) < count:
+                entities.append(iterator.next())
+                more = yield iterator.has_next_async()
+
+            cursor = iterator.cursor_after().urlsafe() if entities else None
+            more = bool(entities) and more
+            if self.keys_only:
+                entities = LazyEntityList(entities)
+            raise ndb.Return((entities, cursor, more))
+
+        return fetch()
+
+    def cacheable_results(self, results):
+        # Don't load the entities just to cache them, the keys will do
+        if isinstance(results, LazyEntityList):
+            return results
+        return list(results)
+
+    def sort_key(self, entity):
+        sort_key = []
+        for order in self._total_orders():
+            value = _order_value(entity, order.prop)
+            sort_key.append(Descending(value) if order.direction == PropertyOrder.DESCENDING else value)
+        return tuple(sort_key)
+
     def contains_more_objects(self, next_cursor):
         """
             Returns a boolean telling if there are more objects in the queryset
             or if there aren't.
         """
-        if self._contians_more_entities is not None:
+        # The flag from the last query is only valid for its own end cursor,
+        # the paginator may ask about a cursor it got from the cache.
+        if self._contians_more_entities is not None and next_cursor == self._latest_end_cursor:
             return self._contians_more_entities
 
         entities, cursor, more = self.query.fetch_page(
@@ -89,4 +321,36 @@ class GaeNdbModelManager(ObjectManager):
         )
 
         entity_list = list(entities)
-        return bool(entity_list)
\ No newline at end of file
+        return bool(entity_list)
+
+class WatchedModel(object):
+    """
+        Mix into NDB models (before ndb.Model) whose queries are watched with
+        invalidation.watch(), so puts and deletes update their paginators.
+        Costs an extra get of the stored entity per put or delete, but only
+        while the model is watched.
+    """
+    def _pre_put_hook(self):
+        super(WatchedModel, self)._pre_put_hook()
+        self._watched_previous = None
+        if self.key is not None and invalidation.is_watched(self):
+            self._watched_previous = self.key.get(use_cache=False, use_memcache=False)
+
+    def _post_put_hook(self, future):
+        super(WatchedModel, self)._post_put_hook(future)
+        if invalidation.is_watched(self) and future.get_exception() is None:
+            previous, self._watched_previous = getattr(self, "_watched_previous", None), None
+            invalidation.object_changed(previous, self)
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        super(WatchedModel, cls)._pre_delete_hook(key)
+        if invalidation.is_watched(cls):
+            _deleting[key] = key.get(use_cache=False, use_memcache=False)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(WatchedModel, cls)._post_delete_hook(key, future)
+        entity = _deleting.pop(key, None)
+        if entity is not None and future.get_exception() is None:
+            invalidation.object_changed(entity, None)
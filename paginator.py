@@ -1,4 +1,8 @@
+import copy
 import logging
+import threading
+import time
+from collections import namedtuple
 from math import ceil
 
 from django.core.cache import cache
@@ -9,20 +13,212 @@ from django.core.paginator import (
     Page
 )
 
+from .local_cache import LocalCache, local_cache
 from .object_managers.base import ObjectManager
+from .stats import PageStats, PaginatorObserver
+from .utils import BackgroundFuture, DeferredFuture, background_pool, model_cache_key
+
+
+# How long (in seconds) a process holds the right to prefetch a batch
+PREFETCH_LEASE_TIMEOUT = 30
+
+# Batches being prefetched by this process, to avoid duplicate prefetches
+_prefetches_in_flight = set()
+_prefetches_lock = threading.Lock()
+
+# How long (in seconds) a process holds the right to run the queries for a
+# batch that others are waiting for, and how often the others check on it
+FLIGHT_LEASE_TIMEOUT = 30
+FLIGHT_POLL_INTERVAL = 0.05
+
+# Batches this process is querying for, with an event for the callers waiting
+_flights = {}
+_flights_lock = threading.Lock()
+
+# How long (in seconds) a process holds the right to count a query, and the
+# counts running in this process
+COUNT_LEASE_TIMEOUT = 120
+_counts_in_flight = set()
+
+# The latest batch_size chosen for each query in adaptive mode, so new
+# paginators in this process start with it instead of re-reading the cache,
+# and the access statistics gathered by this process since the last decision.
+# Bounded, the least recently used queries are forgotten first.
+ADAPTIVE_STATE_TIMEOUT = 3600
+_adaptive_batch_sizes = LocalCache(max_items=1000)
+_adaptive_access = LocalCache(max_items=1000)
 
 
 class CursorNotFound(Exception):
     pass
 
+
+# What UnifiedPaginator.count_estimate() returns. count is a lower bound
+# unless exact, age is how old (in seconds) a cached count is.
+CountEstimate = namedtuple("CountEstimate", ["count", "exact", "age"])
+
+
+class PageSnapshot(namedtuple("PageSnapshot", [
+        "known_page_count", "known_items_count", "final_page", "final_item", "batch_size", "cached_count"])):
+    """
+        The counts of the query as they were when a page was served. The page
+        renders from it, so the values can't change halfway through and the
+        cache isn't read again. cached_count is the cached (count, time
+        counted), if there was one.
+    """
+    __slots__ = ()
+
+
+def _estimate_count(final_item, known_items, cached_count, max_age):
+    """
+        Returns a CountEstimate for the given counts, and whether the cached
+        count should be refreshed.
+    """
+    if final_item is not None:
+        return CountEstimate(final_item, True, 0), False
+
+    known_items = known_items or 0
+    if cached_count is None:
+        return CountEstimate(known_items, False, None), True
+
+    count, counted_at = cached_count
+    age = time.time() - counted_at
+    if age > max_age:
+        return CountEstimate(max(count, known_items), False, age), True
+    return CountEstimate(count, True, age), False
+
+
+def _is_power_of_two(number):
+    return number > 0 and number & (number - 1) == 0
+
+
+def _model_generation_key(model_key):
+    return "|".join([model_key, "MODEL_GENERATION"])
+
+
+def flush_model_cache(model):
+    """
+        Invalidates everything the paginators of all queries on the given model
+        (a model class or kind name) have cached, with a single increment.
+    """
+    try:
+        cache.incr(_model_generation_key(model_cache_key(model)))
+    except ValueError:
+        # Nothing was cached for this model yet
+        pass
+
+
+def _finished_future(result=None, exception=None):
+    future = BackgroundFuture()
+    future._finish(result=result, exception=exception)
+    return future
+
+
+def get_pages(requests):
+    """
+        Serves several pages at once, e.g. for a page with several listings.
+        Takes (paginator, number) pairs and returns the pages in the same
+        order. The cache entries of all of them are read with a single
+        get_many() and their batch queries run in parallel, like with
+        page_async(). If a page can't be served, its exception is raised once
+        the others are done.
+    """
+    requests = [
+        (paginator._detached_copy(), paginator.validate_number(number))
+        for paginator, number in requests
+    ]
+
+    keys = set()
+    for paginator, number in requests:
+        keys.update(paginator._prefetch_keys(paginator._page_suffixes(number - 1)))
+        keys.update(paginator._generation_keys())
+    values = cache.get_many(list(keys))
+
+    futures = []
+    for paginator, number in requests:
+        if paginator._coalesce_timeout:
+            futures.append(background_pool.submit_or_defer(paginator.page, number))
+        else:
+            futures.append(paginator._page_async(number, values))
+
+    pages, error = [], None
+    for future in futures:
+        try:
+            pages.append(future.get_result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    return pages
+
+
+class PageFuture(object):
+    """
+        What UnifiedPaginator.page_async() returns for a page whose batch query
+        is running. get_result() waits for the query and then finishes the
+        page on the calling thread, the first time it's called.
+    """
+    def __init__(self, fetch, finish):
+        self._fetch = fetch
+        self._finish = finish
+        self._lock = threading.Lock()
+        self._finished = False
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """ Whether get_result() won't have to wait for the datastore """
+        return self._finished or self._fetch.done()
+
+    def get_result(self):
+        with self._lock:
+            if not self._finished:
+                try:
+                    self._result = self._finish(self._fetch.get_result())
+                except Exception as e:
+                    self._exception = e
+                self._finished = True
+
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
 class UnifiedPaginator(Paginator):
     _static_cache_suffixes = {
-        "LAST_PAGE": "LAST_PAGE",
-        "LAST_ITEM": "LAST_ITEM",
-        "KNOWN_PAGE_MAX": "KNOWN_PAGE_MAX",
-        "KNOWN_ITEMS_MAX": "KNOWN_ITEMS_MAX"
+        "GENERATION": "GENERATION",
     }
 
+    # The metadata read with every page. Each value is kept in a cache entry
+    # of its own, so a request only writes back the values it changed and
+    # can't undo what concurrent requests wrote to the others.
+    _page_metadata = ("LAST_PAGE", "LAST_ITEM", "END_CURSOR", "KNOWN_PAGE_MAX", "KNOWN_ITEMS_MAX")
+
+    # How many batch boundaries below the requested one are checked for a
+    # cached cursor to continue from. page() only reads the requested one with
+    # its bulk read, the ones below it only if that one is missing.
+    cursor_lookback = 100
+
+    # Adaptive batch_size: how many rows the overhead of one query is worth,
+    # how many requests pass between decisions and how quickly older requests
+    # stop counting.
+    adaptive_query_cost = 20
+    adaptive_interval = 100
+    adaptive_decay = 0.99
+
+    # How many keys of a materialized key list are stored per cache entry
+    key_list_chunk_size = 1000
+
+    # Cached counts older than this (in seconds) are refreshed in the background
+    count_max_age = 300
+
+    # Whether page() starts a count in the background when the page's count
+    # estimate isn't exact, for listings which show the count
+    count_on_page = False
+
+    # With track_changes, no more cursors than this are cached per query
+    tracked_boundaries_max = 2000
+
     def __init__(self, object_list, per_page, batch_size=1, readahead=True, *args, **kwargs):
         """
             batch_size - The steps (in pages) that cursors are cached. A batch_size
@@ -32,81 +228,465 @@ class UnifiedPaginator(Paginator):
             anything actually there. This makes page counts behave correctly at the
             cost of an extra keys_only query using the cursor as an offset. This isn't
             used on IN queries as that would be slow as molasses
+
+            The other positional arguments go to Django's Paginator (orphans,
+            allow_empty_first_page), the options below are keyword only.
+
+            batch_cache_timeout - If set, the results of each batch query are
+            cached for this many seconds, so the other pages of the same batch
+            are served without touching the datastore.
+
+            batch_cache_max_items - Batches with more objects than this are
+            never cached, to stay clear of the cache's value size limit.
+
+            page_cursors - Also store the cursors for the pages inside a batch,
+            if the object manager can read them from the batch query. Pages
+            with a cursor are then read on their own instead of with the
+            whole batch.
+
+            prefetch_distance - If set, serving one of the last prefetch_distance
+            pages of a batch starts fetching the next batch in the background.
+            It lands in the batch cache, so batch_cache_timeout must be set too.
+
+            observer - A stats.PaginatorObserver which gets the PageStats of
+            every page() call.
+
+            adaptive_batch_size - If set, the batch_size is chosen from the
+            powers of two up to this value, based on how the query is being
+            paged through, and batch_size is only the starting point. See
+            _batch_size_costs() for how, and batch_size_decisions() for what
+            was decided.
+
+            coalesce_timeout - If set, concurrent page() calls (in this process
+            or others) that need the same uncached batch or cursor don't all
+            query for it: the first one does and publishes the results, the
+            others wait up to this many seconds for them.
+
+            key_list_timeout - For queries that can't use cursors: if set, the
+            ordered keys of the first key_list_max_items objects are read once
+            with a keys only query and cached for this many seconds, and pages
+            are then read by key. Pages past the end of the list are read with
+            an offset as usual.
+
+            local_cache_timeout - If set, everything this paginator caches is
+            also kept in an in-process LRU cache (local_cache.local_cache) for
+            up to this many seconds, in front of the shared cache. The query's
+            and the model's generations are still read from the shared cache
+            every time, so flush_cache() and flush_model_cache() take effect
+            straight away; other changes can take this long to show.
+
+            track_changes - Remember the sort key of the last object before
+            every cached cursor, so that object_changed() only has to drop the
+            cursors which a change actually moved (see invalidation.watch()).
+            Past tracked_boundaries_max cursors no more are cached.
         """
+        batch_cache_timeout = kwargs.pop("batch_cache_timeout", None)
+        batch_cache_max_items = kwargs.pop("batch_cache_max_items", 200)
+        page_cursors = kwargs.pop("page_cursors", False)
+        prefetch_distance = kwargs.pop("prefetch_distance", None)
+        observer = kwargs.pop("observer", None)
+        adaptive_batch_size = kwargs.pop("adaptive_batch_size", None)
+        coalesce_timeout = kwargs.pop("coalesce_timeout", None)
+        key_list_timeout = kwargs.pop("key_list_timeout", None)
+        key_list_max_items = kwargs.pop("key_list_max_items", 10000)
+        local_cache_timeout = kwargs.pop("local_cache_timeout", None)
+        track_changes = kwargs.pop("track_changes", False)
 
         self._batch_size = batch_size
         self._readahead = readahead
+        self._batch_cache_timeout = batch_cache_timeout
+        self._batch_cache_max_items = batch_cache_max_items
+        self._prefetch_distance = prefetch_distance
+        self._coalesce_timeout = coalesce_timeout
+        self._local_cache_timeout = local_cache_timeout
+        self._track_changes = track_changes
+        # (future, cache key) of the prefetches started by this paginator
+        self._prefetches = []
+        self._cancelled_prefetches = set()
+        self._observer = observer or PaginatorObserver()
+        # The PageStats of the page() call in progress
+        self._stats = None
+
+        if prefetch_distance is not None and not batch_cache_timeout:
+            raise ValueError('prefetch_distance needs batch_cache_timeout to be set')
+
+        self._adaptive_batch_size = adaptive_batch_size
+        if adaptive_batch_size:
+            # With powers of two every boundary of a bigger batch_size is also
+            # a boundary of the smaller ones, so the cursors stored with one
+            # batch_size stay usable with the others.
+            if not _is_power_of_two(adaptive_batch_size) or not _is_power_of_two(batch_size):
+                raise ValueError('adaptive_batch_size and batch_size must be powers of two')
+            if batch_size > adaptive_batch_size:
+                raise ValueError('batch_size can\'t be bigger than adaptive_batch_size')
+            self._batch_size = _adaptive_batch_sizes.get_many([object_list.cache_key]).get(object_list.cache_key, batch_size)
+
+        # The metadata values read so far by name, the ones in _page_metadata
+        # are loaded once per page() call.
+        self._metadata = None
+        # While page() is running, cache writes are collected here and sent
+        # with a single set_many() at the end.
+        self._pending_writes = None
+        # Values read by the bulk cache read at the start of page()
+        self._prefetched = {}
+        # Every value we cache is stored together with the query's and the
+        # model's generation at the time. Bumping either one invalidates them.
+        self._generation = None
 
         if not isinstance(object_list, ObjectManager):
             raise TypeError('%s doesn\'t support standard object lists. Please make sure it\'s a subclass of %s' % (self.__class__.__name__, ObjectManager.__name__))
 
         if not object_list.supports_cursors:
             self._readahead = False
+            page_cursors = False
+
+        if key_list_timeout and not object_list.supports_key_lists:
+            raise ValueError('%s can\'t read objects by key' % object_list.__class__.__name__)
+        self._key_list_timeout = key_list_timeout if not object_list.supports_cursors else None
+        self._key_list_max_items = key_list_max_items
+
+        self._store_page_cursors = page_cursors
+        if page_cursors:
+            object_list.cursor_step = per_page
 
         super(UnifiedPaginator, self).__init__(object_list, per_page, *args, **kwargs)
 
     def flush_cache(self):
+        """ Invalidates everything cached for this query with a single increment """
+        try:
+            cache.incr(self._make_key("GENERATION"))
+        except ValueError:
+            # Nothing was cached for this query yet
+            pass
 
-        cache_suffixes = self._static_cache_suffixes.values()
+        self._metadata = None
+        self._generation = None
 
-        known_page_max = self._get_known_page_count()
+    def object_changed(self, old_sort_key=None, new_sort_key=None):
+        """
+            Updates what is cached for the query after one of its objects was
+            added (no old_sort_key), removed (no new_sort_key) or moved. The
+            sort keys are the object manager's sort_key() of the object before
+            and after the change.
+
+            Cursors before the change stay cached, only those after it (up to
+            the new position, for a move) are dropped, together with the
+            cached batches they start. The known counts are adjusted rather
+            than forgotten. Without track_changes we don't know where the
+            cursors are, so everything is flushed.
+        """
+        if old_sort_key is None and new_sort_key is None:
+            return
+        if not self._track_changes:
+            self.flush_cache()
+            return
 
-        if known_page_max:
-            for i in range(int(known_page_max)+1):
-                cache_suffixes.append(str(i))
+        delta = (new_sort_key is not None) - (old_sort_key is not None)
+        low = min(key for key in (old_sort_key, new_sort_key) if key is not None)
+        high = max(old_sort_key, new_sort_key) if not delta else None
 
-        for suffix in cache_suffixes:
-            key = self._make_key(suffix)
-            cache.delete(key)
+        self._pending_writes = {}
+        try:
+            self._prefetch(["COUNT"])
+            boundaries = dict(self._get_metadata("BOUNDARIES") or {})
+
+            # The change is after the last cursor behind an object that sorts
+            # before it, and (for a move) before the first cursor behind an
+            # object that sorts after it. Cursors outside that stay valid.
+            first_page = max([0] + [page for page, key in boundaries.items() if key is not None and key < low])
+            end_page = max([
+                self._get_known_page_count() or 0, self._get_final_page() or 0
+            ] + boundaries.keys()) + 1
+            if high is not None:
+                end_page = min([end_page] + [page for page, key in boundaries.items() if key is not None and key > high])
+
+            moved = []
+            if old_sort_key != new_sort_key:
+                moved = [page for page in boundaries if first_page < page < end_page]
+            for page in moved:
+                del boundaries[page]
+
+            keys = [self._make_key(str(page)) for page in moved]
+            if self._batch_cache_timeout:
+                batch_sizes = [self._batch_size]
+                if self._adaptive_batch_size:
+                    batch_sizes = [size for size in xrange(self._adaptive_batch_size + 1) if _is_power_of_two(size)]
+                for batch_size in batch_sizes:
+                    start = first_page - first_page % batch_size
+                    for page in xrange(start, end_page, batch_size):
+                        bottom = page * self.per_page
+                        keys.append(self._make_key("BATCH_%d_%d" % (bottom, bottom + batch_size * self.per_page)))
+            cache.delete_many(keys)
+            local_cache.delete_many(keys)
+
+            if moved:
+                self._put_metadata("BOUNDARIES", boundaries)
+                if self._get_metadata("WARMED_PAGE") > first_page:
+                    self._put_metadata("WARMED_PAGE", first_page)
+            if delta or old_sort_key != new_sort_key:
+                # Cursor-less queries read by key from a list in the old order
+                self._put_metadata("KEY_LIST", None)
+
+            if delta:
+                final_item = self._get_final_item()
+                if final_item is not None:
+                    final_item = max(final_item + delta, 0)
+                    final_page = int(ceil(final_item / float(self.per_page)))
+                    self._put_final_item(final_item, self._get_metadata("END_CURSOR"))
+                    self._put_final_page(final_page)
+                    self._put_known_items_count(final_item)
+                    self._put_known_page_count(final_page)
+                elif self._get_known_items_count() is not None:
+                    known_items = max(self._get_known_items_count() + delta, 0)
+                    self._put_known_items_count(known_items)
+                    # Plus the page we assume there is after the known items
+                    known_pages = int(ceil(known_items / float(self.per_page))) + 1
+                    if delta < 0 and self._get_known_page_count() > known_pages:
+                        self._put_known_page_count(known_pages)
+
+                cached_count = self._prefetched.get("COUNT")
+                if cached_count is not None:
+                    count, counted_at = cached_count
+                    self._cache_set(self._make_key("COUNT"), (max(count + delta, 0), counted_at))
+        finally:
+            self._flush_pending_writes()
 
     def _make_key(self, suffix):
         return "|".join([self.object_list.cache_key, self._static_cache_suffixes.get(suffix, suffix)])
 
+    def _generation_keys(self):
+        keys = [self._make_key("GENERATION")]
+        model_key = self.object_list.model_cache_key
+        if model_key:
+            keys.append(_model_generation_key(model_key))
+        return keys
+
+    def _read_generation(self, values):
+        """ Reads the current generation from the result of a get_many() """
+        generation = []
+        for key in self._generation_keys():
+            value = values.get(key)
+            if value is None:
+                # Start from the current time rather than 0, so values cached
+                # before the generation got evicted can't become valid again.
+                # Not counted as a write of the page, it's done once per cache.
+                # It never expires, the default timeout would flush everything
+                value = int(time.time() * 1000)
+                if not cache.add(key, value, None):
+                    # Someone else started it, unless it got evicted again
+                    value = cache.get(key) or value
+            generation.append(value)
+        return tuple(generation)
+
+    def _unwrap(self, entry):
+        """ Returns a cached value if it belongs to the current generation """
+        if entry is None or entry[0] != self._generation:
+            return None
+        return entry[1]
+
+    def _cache_set(self, key, value, timeout=None):
+        if self._generation is None:
+            self._load_metadata()
+        value = (self._generation, value)
+
+        if self._pending_writes is not None:
+            self._pending_writes.setdefault(timeout, {})[key] = value
+            return
+
+        if timeout is None:
+            cache.set(key, value)
+        else:
+            cache.set(key, value, timeout)
+        self._local_set({key: value}, timeout)
+
+    def _local_set(self, values, timeout=None):
+        """ Writes values through to the local cache tier, if it's used """
+        if not self._local_cache_timeout:
+            return
+        if timeout is not None:
+            timeout = min(timeout, self._local_cache_timeout)
+        local_cache.set_many(values, timeout or self._local_cache_timeout)
+
+    def _flush_pending_writes(self):
+        writes, self._pending_writes = self._pending_writes, None
+        if not writes:
+            return
+
+        if self._stats is not None:
+            self._stats.cache_writes += len(writes)
+
+        # One set_many per distinct timeout, usually just the one
+        for timeout, values in writes.items():
+            if timeout is None:
+                cache.set_many(values)
+            else:
+                cache.set_many(values, timeout)
+            self._local_set(values, timeout)
+
+    def _prefetch_keys(self, suffixes):
+        """ The cache keys _prefetch() reads for the given suffixes, with their suffix """
+        return dict((self._make_key(suffix), suffix) for suffix in set(suffixes) | set(self._metadata_suffixes()))
+
+    def _metadata_suffixes(self):
+        """ The metadata entries read with every page, the others are read when needed """
+        names = list(self._page_metadata)
+        if self._adaptive_batch_size:
+            names.append("BATCH_SIZE")
+        if self._track_changes:
+            names.append("BOUNDARIES")
+        if self._key_list_timeout:
+            names.append("KEY_LIST")
+        return ["METADATA_%s" % name for name in names]
+
+    def _prefetch(self, suffixes, values=None):
+        """
+            Reads the metadata entries and the given cache suffixes with a single
+            cache round trip. The values are kept in self._prefetched for the
+            rest of the page() call.
+
+            values - The result of a get_many() of the _prefetch_keys() and the
+            generation keys if the caller did the round trip already, e.g.
+            get_pages() for several paginators at once.
+        """
+        keys = self._prefetch_keys(suffixes)
+        # The metadata is written back from what was read, so an older local
+        # copy of it would undo what other processes found out meanwhile
+        local_keys = [key for key, suffix in keys.items() if not suffix.startswith("METADATA")]
+        local_values = {}
+        if self._local_cache_timeout:
+            local_values = local_cache.get_many(local_keys)
+
+        if values is None:
+            values = cache.get_many([key for key in keys if key not in local_values] + self._generation_keys())
+        else:
+            # A copy, the local values are added to it
+            values = dict(values)
+        if self._stats is not None:
+            self._stats.cache_reads += 1
+            self._stats.local_cache_hits += len(local_values)
+
+        self._generation = self._read_generation(values)
+        if self._local_cache_timeout:
+            self._local_set(dict((key, values[key]) for key in local_keys if key in values))
+
+            # Values from before a flush have to be read from the shared cache
+            stale = [key for key, value in local_values.items() if value[0] != self._generation]
+            if stale:
+                local_values.update(cache.get_many(stale))
+                if self._stats is not None:
+                    self._stats.cache_reads += 1
+                    self._stats.local_cache_hits -= len(stale)
+            values.update(local_values)
+
+        self._prefetched = dict((suffix, self._unwrap(values.get(key))) for key, suffix in keys.items())
+        self._metadata = dict(
+            (suffix[len("METADATA_"):], value) for suffix, value in self._prefetched.items()
+            if suffix.startswith("METADATA_")
+        )
+
+    def _page_suffixes(self, zero_based_page):
+        """ Returns the cache suffixes page() is going to read for the given page """
+        page_with_cursor = self._find_nearest_page_with_cursor(zero_based_page)
+        suffixes = []
+
+        if self.object_list.supports_cursors and page_with_cursor > 0:
+            suffixes.append(str(page_with_cursor))
+
+        if self._store_page_cursors and zero_based_page != page_with_cursor:
+            suffixes.append(str(zero_based_page))
+
+        if self._batch_cache_timeout:
+            suffixes.append(self._batch_suffix(page_with_cursor))
+
+        if self._prefetch_distance is not None:
+            # So we know whether the next batch still needs prefetching
+            suffixes.append(self._batch_suffix(page_with_cursor + self._batch_size))
+
+        if self._key_list_timeout:
+            suffixes.extend(self._key_list_suffixes(zero_based_page))
+
+        # For the page's count estimate
+        suffixes.append("COUNT")
+        return suffixes
+
+    def _load_metadata(self):
+        self._prefetch([])
+
+    def _get_metadata(self, name):
+        if self._metadata is None:
+            self._load_metadata()
+        if name not in self._metadata:
+            self._metadata[name] = self._unwrap(cache.get(self._make_key("METADATA_%s" % name)))
+            if self._stats is not None:
+                self._stats.cache_reads += 1
+        return self._metadata[name]
+
+    def _put_metadata(self, name, value):
+        if self._get_metadata(name) == value:
+            return
+
+        self._metadata[name] = value
+        self._cache_set(self._make_key("METADATA_%s" % name), value)
+
     def _get_final_page(self):
-        key = self._make_key("LAST_PAGE")
-        return cache.get(key)
+        return self._get_metadata("LAST_PAGE")
 
     def _put_final_page(self, page):
-        key = self._make_key("LAST_PAGE")
-        cache.set(key, page)
+        self._put_metadata("LAST_PAGE", page)
 
     def _get_final_item(self):
-        key = self._make_key("LAST_ITEM")
-        return cache.get(key)
+        return self._get_metadata("LAST_ITEM")
 
-    def _put_final_item(self, item):
-        key = self._make_key("LAST_ITEM")
-        cache.set(key, item)
+    def _put_final_item(self, item, end_cursor=None):
+        """
+            end_cursor - The cursor after the last object, if known. Reading
+            from the end checks with it that nothing was added since.
+        """
+        if end_cursor is None and item == self._get_final_item():
+            end_cursor = self._get_metadata("END_CURSOR")
+        self._put_metadata("LAST_ITEM", item)
+        self._put_metadata("END_CURSOR", end_cursor)
 
     def _get_known_page_count(self):
-        key = self._make_key("KNOWN_PAGE_MAX")
-        return cache.get(key)
+        return self._get_metadata("KNOWN_PAGE_MAX")
 
     def _put_known_page_count(self, count):
-        key = self._make_key("KNOWN_PAGE_MAX")
-        return cache.set(key, count)
+        self._put_metadata("KNOWN_PAGE_MAX", count)
 
     def _get_known_items_count(self):
         """ Use this when you don't know how many pages there is """
-        key = self._make_key("KNOWN_ITEMS_MAX")
-        return cache.get(key)
+        return self._get_metadata("KNOWN_ITEMS_MAX")
 
     def _put_known_items_count(self, count):
-        key = self._make_key("KNOWN_ITEMS_MAX")
-        return cache.set(key, count)
+        self._put_metadata("KNOWN_ITEMS_MAX", count)
 
-    def _put_cursor(self, zero_based_page, cursor):
+    def _put_cursor(self, zero_based_page, cursor, objects=None, end=None):
+        """
+            Caches the cursor for the start of the given page. objects[:end]
+            are the objects read up to the cursor, with track_changes the sort
+            key of the last one is recorded in the BOUNDARIES metadata. Only
+            that one is looked at, so keys only results aren't all loaded.
+        """
         if not self.object_list.supports_cursors or cursor is None:
             return
 
-        logging.info("Storing cursor for page: %s" % (zero_based_page))
+        if self._track_changes:
+            boundaries = self._get_metadata("BOUNDARIES") or {}
+            if boundaries.get(zero_based_page) is None:
+                if zero_based_page not in boundaries and len(boundaries) >= self.tracked_boundaries_max:
+                    return
+                # A copy, the prefetched one is only replaced by _put_metadata()
+                boundaries = dict(boundaries)
+                end = len(objects) if objects is not None and end is None else end
+                boundaries[zero_based_page] = self.object_list.sort_key(objects[end - 1]) if end else None
+                self._put_metadata("BOUNDARIES", boundaries)
+
         key = self._make_key(str(zero_based_page))
-        cache.set(key, cursor)
+        self._cache_set(key, cursor)
 
     def _get_cursor(self, zero_based_page):
-        logging.info("Getting cursor for page: %s" % (zero_based_page))
-        key = self._make_key(str(zero_based_page))
-        result = cache.get(key)
+        self._prefetch([str(zero_based_page)])
+        result = self._prefetched.get(str(zero_based_page))
         if result is None:
             raise CursorNotFound("No cursor available for %s" % zero_based_page)
         return result
@@ -136,6 +716,163 @@ class UnifiedPaginator(Paginator):
             page_with_cursor -= 1
         return page_with_cursor
 
+    def _lower_cursor_boundaries(self, page_with_cursor):
+        """ Batch boundaries from page_with_cursor downwards, limited by cursor_lookback """
+        lowest = max(self._batch_size, page_with_cursor - self.cursor_lookback * self._batch_size)
+        return range(page_with_cursor, lowest - 1, -self._batch_size)
+
+    def _nearest_cached_cursor(self, page_with_cursor):
+        """
+            Returns the highest (page, cursor) at or below page_with_cursor that
+            is cached, or (0, None) for the start. If page_with_cursor's own
+            cursor is missing, the ones below it which weren't read yet are
+            read with a single get_many().
+        """
+        if page_with_cursor == 0:
+            return 0, None
+        if self._prefetched.get(str(page_with_cursor)):
+            return page_with_cursor, self._prefetched[str(page_with_cursor)]
+
+        # No cursors are cached for pages nobody got to yet
+        known_pages = max(self._get_known_page_count() or 0, self._get_final_page() or 0)
+        boundaries = [boundary for boundary in self._lower_cursor_boundaries(page_with_cursor) if boundary <= known_pages]
+        self._read_more([str(boundary) for boundary in boundaries if str(boundary) not in self._prefetched])
+        for boundary in boundaries:
+            cursor = self._prefetched.get(str(boundary))
+            if cursor:
+                return boundary, cursor
+        return 0, None
+
+    def _read_more(self, suffixes):
+        """ Reads more cache suffixes into self._prefetched, e.g. in the middle of page() """
+        if not suffixes:
+            return
+        keys = dict((self._make_key(suffix), suffix) for suffix in suffixes)
+        values = cache.get_many(keys.keys())
+        if self._stats is not None:
+            self._stats.cache_reads += 1
+        for key, suffix in keys.items():
+            self._prefetched[suffix] = self._unwrap(values.get(key))
+
+    def _plan_read_from_end(self, number):
+        """
+            Returns the (bottom, top, skip) for reading the given page from the
+            end, or None if the end isn't known or isn't closer to the page
+            than any cursor we have.
+        """
+        final_item = self._get_final_item()
+        if not final_item or not self.object_list.supports_reverse or not self._get_metadata("END_CURSOR"):
+            return None
+
+        bottom = (number - 1) * self.per_page
+        top = min(bottom + self.per_page, final_item)
+        if bottom >= final_item:
+            return None
+
+        page_with_cursor = self._find_nearest_page_with_cursor(number - 1)
+        start_page, start_cursor = self._nearest_cached_cursor(page_with_cursor)
+        if start_page == page_with_cursor:
+            return None
+
+        skip = final_item - top
+        if skip >= (page_with_cursor - start_page) * self.per_page:
+            return None
+        return bottom, top, skip
+
+    def _read_from_end(self, number):
+        """
+            Reads the given page with the query in reverse order, if the end of
+            the query is known and closer to the page than any cursor we have.
+            Returns None if it isn't worth it.
+        """
+        plan = self._plan_read_from_end(number)
+        if plan is None:
+            return None
+        bottom, top, skip = plan
+
+        # The end may have moved since it was found, if objects were added
+        self._stats.queries += 1
+        if self.object_list.contains_more_objects(self._get_metadata("END_CURSOR")):
+            self._put_final_page(None)
+            self._put_final_item(None)
+            return None
+
+        manager = self.object_list.reversed()
+        if skip:
+            self._stats.queries += 1
+            self._stats.keys_skipped = skip
+            cursor = manager.skip_ahead(skip)
+            if cursor is None:
+                # There are fewer objects than we thought, go the long way
+                return None
+            manager.starting_cursor(cursor)
+
+        self._stats.queries += 1
+        results = manager[:top - bottom]
+        self._stats.rows_fetched = len(results)
+        return results[::-1]
+
+    def _key_list_suffixes(self, zero_based_page):
+        """ The key list chunks holding the keys of the given page """
+        bottom = zero_based_page * self.per_page
+        top = bottom + self.per_page - 1
+        chunks = range(bottom // self.key_list_chunk_size, top // self.key_list_chunk_size + 1)
+        return ["KEYS_%d" % chunk for chunk in chunks]
+
+    def _materialize_key_list(self):
+        """ Reads and caches the ordered keys of the query, returns them """
+        self._stats.queries += 1
+        keys = self.object_list.fetch_keys(self._key_list_max_items + 1)
+        complete = len(keys) <= self._key_list_max_items
+        keys = keys[:self._key_list_max_items]
+        self._stats.keys_skipped = len(keys)
+
+        for i in xrange(0, max(len(keys), 1), self.key_list_chunk_size):
+            suffix = "KEYS_%d" % (i // self.key_list_chunk_size)
+            self._cache_set(self._make_key(suffix), keys[i:i + self.key_list_chunk_size], self._key_list_timeout)
+        self._put_metadata("KEY_LIST", {
+            "count": len(keys),
+            "complete": complete,
+            "expires": time.time() + self._key_list_timeout,
+        })
+        if complete:
+            self._put_final_item(len(keys))
+            self._put_final_page(int(ceil(len(keys) / float(self.per_page))))
+        return keys
+
+    def _read_from_key_list(self, number):
+        """
+            Reads the given page by key from the materialized key list,
+            building the list first if needed. Returns the objects and whether
+            there are more, or None if the page goes past the end of a list
+            that was cut off at key_list_max_items.
+        """
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+
+        key_list = self._get_metadata("KEY_LIST")
+        suffixes = self._key_list_suffixes(number - 1)
+        chunks = [self._prefetched.get(suffix) for suffix in suffixes]
+        if key_list is None or key_list["expires"] < time.time() or (
+                bottom < key_list["count"] and None in chunks):
+            keys = self._materialize_key_list()[bottom:top]
+            key_list = self._get_metadata("KEY_LIST")
+        else:
+            first_chunk = int(suffixes[0].split("_")[1])
+            keys = sum([chunk or [] for chunk in chunks], [])
+            offset = bottom - first_chunk * self.key_list_chunk_size
+            keys = keys[offset:offset + self.per_page]
+
+        if top > key_list["count"] and not key_list["complete"]:
+            # Not (entirely) in the list
+            return None
+
+        self._stats.queries += 1
+        results = self.object_list.get_by_keys(keys)
+        self._stats.rows_fetched = len(results)
+        more_objects = top < key_list["count"] or not key_list["complete"]
+        return results, more_objects
+
     def _get_cursor_and_offset(self, page):
         """ Returns a cursor and offset for the page. page is zero-based! """
 
@@ -143,50 +880,545 @@ class UnifiedPaginator(Paginator):
         cursor = None
         page_with_cursor = self._find_nearest_page_with_cursor(page)
 
-        if self.object_list.supports_cursors:
-            if page_with_cursor > 0:
-                try:
-                    cursor = self._get_cursor(page_with_cursor)
-                    logging.info("Using existing cursor from memcache")
-                except CursorNotFound:
-                    logging.info("Couldn't find a cursor")
-                    #No cursor found, so we just return the offset old-skool-style.
-                    cursor = None
+        if self.object_list.supports_cursors and page_with_cursor > 0:
+            # The cursors were read together with the metadata record
+            cursor = self._prefetched.get(str(page_with_cursor))
+            self._stats.cursor_hit = bool(cursor)
+            if not cursor:
+                # Continue from the highest cursor we have below the batch (or
+                # from the start) and skip the rest with a keys only query.
+                start_page, start_cursor = self._nearest_cached_cursor(page_with_cursor)
+
+                batches = (page_with_cursor - start_page) // self._batch_size
+                self._stats.keys_skipped = batches * self._batch_size * self.per_page
+                cursors = self.object_list.cursors_ahead(
+                    self.per_page * self._batch_size,
+                    batches,
+                    start_cursor=start_cursor
+                )
+                self._stats.queries += self.object_list.cursors_ahead_queries(batches, len(cursors))
+
+                # Keep every batch boundary we walked past, they all go out
+                # with the single set_many() at the end of page()
+                for i, batch_cursor in enumerate(cursors):
+                    self._put_cursor(start_page + (i + 1) * self._batch_size, batch_cursor)
+
+                if len(cursors) < batches:
+                    raise EmptyPage('That page contains no results')
+                cursor = cursors[-1]
 
         offset = (page - page_with_cursor) * self.per_page
 
         return cursor, offset
 
-    def _process_batch_hook(self, batch_results, zero_based_page, cursor, offset):
-        """ Override this in the subclass to cache results etc."""
-        pass
+    def _batch_suffix(self, page_with_cursor):
+        bottom = self.per_page * page_with_cursor
+        top = bottom + (self.per_page * self._batch_size)
+        return "BATCH_%d_%d" % (bottom, top)
+
+    def _get_page_cursor(self, zero_based_page):
+        """ Returns the stored cursor for a page inside a batch, if there is one """
+        if not self._store_page_cursors:
+            return None
+        if zero_based_page == self._find_nearest_page_with_cursor(zero_based_page):
+            return None
+        return self._prefetched.get(str(zero_based_page))
+
+    def _put_page_cursors(self, page_with_cursor, results):
+        """ Stores the cursors the last batch query collected for the pages inside it """
+        if not self._store_page_cursors:
+            return
+
+        for i, cursor in enumerate(self.object_list.page_cursors[:self._batch_size - 1]):
+            self._put_cursor(page_with_cursor + i + 1, cursor, results, (i + 1) * self.per_page)
+
+    def _get_cached_batch(self, page_with_cursor):
+        """ Returns a (results, next_cursor, more_objects) tuple if the batch was cached """
+        if not self._batch_cache_timeout:
+            return None
+        return self._prefetched.get(self._batch_suffix(page_with_cursor))
+
+    def _process_batch_hook(self, batch_results, zero_based_page, cursor, offset, next_cursor=None, more_objects=None):
+        """
+            Called with the results of every batch query. Caches the batch if
+            batch_cache_timeout is set, override this in the subclass to cache
+            results elsewhere etc.
+        """
+        if not self._batch_cache_timeout or len(batch_results) > self._batch_cache_max_items:
+            return
+
+        page_with_cursor = self._find_nearest_page_with_cursor(zero_based_page)
+        self._cache_set(
+            self._make_key(self._batch_suffix(page_with_cursor)),
+            (self.object_list.cacheable_results(batch_results), next_cursor, more_objects),
+            self._batch_cache_timeout
+        )
+
+    def _should_prefetch(self, number, first_page, page_count, next_cursor):
+        if self._prefetch_distance is None or not next_cursor:
+            return False
+
+        # Only whole batches are followed by a batch boundary
+        if page_count != self._batch_size:
+            return False
+
+        next_batch = first_page + page_count
+        if next_batch - number >= self._prefetch_distance:
+            return False
+
+        if self._get_known_page_count() <= next_batch or self._get_final_page() == next_batch:
+            return False
+
+        return self._prefetched.get(self._batch_suffix(next_batch)) is None
+
+    def _start_prefetch(self, page_with_cursor, cursor):
+        """ Starts fetching the batch at page_with_cursor into the batch cache """
+        suffix = self._batch_suffix(page_with_cursor)
+        key = self._make_key(suffix)
+
+        with _prefetches_lock:
+            if key in _prefetches_in_flight:
+                return
+            _prefetches_in_flight.add(key)
+
+        future = None
+        lease_key = self._make_key("PREFETCH_" + suffix)
+        leased = False
+        try:
+            # Only one process gets to prefetch a batch
+            self._stats.cache_writes += 1
+            leased = cache.add(lease_key, True, PREFETCH_LEASE_TIMEOUT)
+            if leased:
+                future = self.object_list.fetch_async(self.per_page * self._batch_size, start_cursor=cursor)
+        finally:
+            if future is None:
+                if leased:
+                    # The fetch couldn't be started, let the next request try
+                    cache.delete(lease_key)
+                with _prefetches_lock:
+                    _prefetches_in_flight.discard(key)
+
+        if future is not None:
+            self._stats.queries += 1
+            self._prefetches.append((future, key))
+            future.add_callback(self._finish_prefetch, future, key, self._generation)
+
+    def _finish_prefetch(self, future, key, generation):
+        try:
+            results, next_cursor, more_objects = future.get_result()
+            if key not in self._cancelled_prefetches and len(results) <= self._batch_cache_max_items:
+                batch = (self.object_list.cacheable_results(results), next_cursor, more_objects)
+                cache.set(key, (generation, batch), self._batch_cache_timeout)
+                self._local_set({key: (generation, batch)}, self._batch_cache_timeout)
+        except Exception:
+            logging.exception("Prefetching %s failed" % key)
+        finally:
+            with _prefetches_lock:
+                _prefetches_in_flight.discard(key)
+
+    def cancel_prefetches(self):
+        """
+            Makes sure the prefetches started by this paginator don't write to
+            the cache. The queries themselves may still run to completion.
+        """
+        for future, key in self._prefetches:
+            self._cancelled_prefetches.add(key)
+        self._prefetches = []
 
     def page(self, number):
         number = self.validate_number(number)
 
-        cursor, offset = self._get_cursor_and_offset(number-1)
+        self._stats = PageStats(number)
+        start = time.time()
 
+        self._pending_writes = {}
+        flight = None
+        try:
+            self._read_page_cache(number)
+            if self._coalesce_timeout:
+                flight = self._join_flight(number)
+            return self._serve_page(number)
+        finally:
+            self._end_page(start, flight)
+
+    def _read_page_cache(self, number, values=None):
+        """ The bulk cache read at the start of a page() call """
+        self._prefetch(self._page_suffixes(number-1), values)
+        if self._adaptive_batch_size and self._follow_batch_size_decision():
+            # Another process changed the batch_size, read its cache entries
+            self._prefetch(self._page_suffixes(number-1))
+
+    def _serve_page(self, number, batch=None):
+        page = self._page(number, batch)
+        if self._adaptive_batch_size:
+            self._record_access(number)
+        # Rendering the page only estimates the count, it's refreshed here
+        if self.count_on_page and page._estimate_count()[1]:
+            self.refresh_count(background=True)
+        return page
+
+    def _end_page(self, start, flight=None):
+        """ Sends the cache writes of a page() call and reports its stats """
+        stats = self._stats
+        try:
+            self._flush_pending_writes()
+            if flight is not None:
+                self._land_flight(flight)
+        finally:
+            self._prefetched = {}
+            self._stats = None
+            stats.wall_time = time.time() - start
+            self._observer.page_served(self, stats)
+
+    def _finish_page(self, number, start, batch=None):
+        try:
+            return self._serve_page(number, batch)
+        finally:
+            self._end_page(start)
+
+    def page_async(self, number):
+        """
+            Starts reading a page and returns a future whose get_result() gives
+            the UnifiedPage that page(number) would. The cache is read right
+            away and the batch query is started with the object manager's
+            fetch_async() (an async query with NDB, a background thread
+            otherwise), so the caller can do other work meanwhile. The rest,
+            i.e. the readahead check (run alongside the cache writes) and the
+            writes, happens in get_result().
+
+            Pages served from the batch cache are ready straight away. Pages
+            read any other way (page cursors, offsets, from the end or by key)
+            and coalesced page loads are read with page() in a background
+            thread. Invalid page numbers raise right away, like with page().
+
+            If no background thread is free, the work is left to
+            get_result() rather than waiting for one.
+        """
+        # Its own copy, so the paginator can serve other pages meanwhile
+        paginator = self._detached_copy()
+        number = paginator.validate_number(number)
+        if paginator._coalesce_timeout:
+            return background_pool.submit_or_defer(paginator.page, number)
+        return paginator._page_async(number)
+
+    def _page_async(self, number, values=None):
+        self._stats = PageStats(number)
+        start = time.time()
+
+        self._pending_writes = {}
+        try:
+            self._read_page_cache(number, values)
+            page_with_cursor = self._find_nearest_page_with_cursor(number - 1)
+            cached = self._get_cached_batch(page_with_cursor) is not None
+            plan = None if cached else self._plan_batch_query(number)
+            fetch = None
+            if plan is not None:
+                fetch = self.object_list.fetch_async(
+                    self.per_page * self._batch_size, start_cursor=plan[0]
+                ) or DeferredFuture(self._fetch_batch, plan[0])
+        except Exception as e:
+            # E.g. an EmptyPage found walking to the cursor
+            self._end_page(start)
+            return _finished_future(exception=e)
+
+        if fetch is not None:
+            return PageFuture(fetch, lambda batch: self._finish_page(number, start, plan + tuple(batch)))
+
+        if not cached:
+            return background_pool.submit_or_defer(self._finish_page, number, start)
+
+        try:
+            return _finished_future(result=self._finish_page(number, start))
+        except Exception as e:
+            return _finished_future(exception=e)
+
+    def _fetch_batch(self, cursor):
+        """ What fetch_async() gives, for when it couldn't start the query """
         if cursor:
             self.object_list.starting_cursor(cursor)
-            results = self.object_list[:(self.per_page * self._batch_size)]
+        results = self.object_list[:self.per_page * self._batch_size]
+        return results, self.object_list.next_cursor, self.object_list.more_objects
+
+    def _plan_batch_query(self, number):
+        """
+            Returns the (cursor, offset) page() is going to read the batch of
+            the page from, walking to the cursor if needed, or None if the
+            page is read some other way.
+        """
+        if self._get_page_cursor(number - 1) or self._key_list_timeout or self._plan_read_from_end(number):
+            return None
+
+        cursor, offset = self._get_cursor_and_offset(number - 1)
+        if not cursor and self._find_nearest_page_with_cursor(number - 1) > 0:
+            # Read with an offset, which fetch_async() doesn't do
+            return None
+        return cursor, offset
+
+    def _readahead_while_flushing(self, next_cursor):
+        """
+            Runs the readahead query in the background while the cache writes
+            collected so far are sent, returns its result.
+        """
+        future = background_pool.try_submit(copy.copy(self.object_list).contains_more_objects, next_cursor)
+        if future is None:
+            return self.object_list.contains_more_objects(next_cursor)
+
+        self._flush_pending_writes()
+        self._pending_writes = {}
+        return future.get_result()
+
+    def _needs_flight(self, number):
+        """ Whether page() is going to query for something others could reuse """
+        page_with_cursor = self._find_nearest_page_with_cursor(number - 1)
+        if self._get_cached_batch(page_with_cursor) is not None or self._get_page_cursor(number - 1):
+            return False
+        if self._batch_cache_timeout:
+            return True
+        # Without the batch cache only the cursor is published
+        return (
+            self.object_list.supports_cursors and page_with_cursor > 0 and
+            not self._prefetched.get(str(page_with_cursor))
+        )
+
+    def _join_flight(self, number):
+        """
+            Makes sure only one caller at a time queries for an uncached batch.
+            Returns the flight to land once the results are published if this
+            caller leads, otherwise waits for the leader, reads the cache again
+            and returns None.
+        """
+        if not self._needs_flight(number):
+            return None
+
+        page_with_cursor = self._find_nearest_page_with_cursor(number - 1)
+        key = self._make_key("FLIGHT_" + self._batch_suffix(page_with_cursor))
+
+        with _flights_lock:
+            event = _flights.get(key)
+            leader = event is None
+            if leader:
+                event = _flights[key] = threading.Event()
+
+        if not leader:
+            event.wait(self._coalesce_timeout)
         else:
-            bottom = (self.per_page * self._find_nearest_page_with_cursor(number-1))
-            top = bottom + (self.per_page * self._batch_size)
-            #No cursor, so grab the full batch
-            results = self.object_list[bottom:top]
+            self._stats.cache_writes += 1
+            if cache.add(key, True, FLIGHT_LEASE_TIMEOUT):
+                return key, event
+
+            # Another process leads, wait for it here on behalf of this one
+            deadline = time.time() + self._coalesce_timeout
+            while time.time() < deadline:
+                self._stats.cache_reads += 1
+                if cache.get(key) is None:
+                    break
+                time.sleep(FLIGHT_POLL_INTERVAL)
+
+            with _flights_lock:
+                _flights.pop(key, None)
+            event.set()
+
+        # Whatever the leader published, or nothing if it took too long
+        self._stats.coalesced = True
+        self._prefetch(self._page_suffixes(number - 1))
+        return None
+
+    def _land_flight(self, flight):
+        """ Lets the callers waiting for a flight know the results are published """
+        key, event = flight
+        try:
+            cache.delete(key)
+        finally:
+            with _flights_lock:
+                _flights.pop(key, None)
+            event.set()
+
+    def _follow_batch_size_decision(self):
+        """ Switches to the latest batch_size decision, returns True if it changed """
+        batch_size = self._get_metadata("BATCH_SIZE") or self._batch_size
+        _adaptive_batch_sizes.set_many({self.object_list.cache_key: batch_size}, ADAPTIVE_STATE_TIMEOUT)
+        if batch_size == self._batch_size:
+            return False
+        self._batch_size = batch_size
+        return True
 
-        self._process_batch_hook(results, number-1, cursor, offset)
+    def _record_access(self, number):
+        """
+            Updates the access statistics of the query with a served page, and
+            every adaptive_interval requests decides on the batch_size for the
+            following ones. The statistics are gathered in process and only
+            cached with a decision, for processes new to the query to start
+            from.
+        """
+        cache_key = self.object_list.cache_key
+        access = _adaptive_access.get_many([cache_key]).get(cache_key)
+        access = dict(access if access is not None else self._get_metadata("ACCESS") or {})
+        decay = self.adaptive_decay
+        last_page = access.get("last_page")
+
+        access["requests"] = access.get("requests", 0) * decay + 1
+        access["jumps"] = access.get("jumps", 0) * decay
+        if last_page is not None and abs(number - last_page) > 1:
+            access["jumps"] += 1
+        access["depth"] = access.get("depth", number) * decay + number * (1 - decay)
+        access["last_page"] = number
+        access["since_decision"] = access.get("since_decision", 0) + 1
+
+        if access["since_decision"] >= self.adaptive_interval:
+            access["since_decision"] = 0
+            self._decide_batch_size(access["jumps"] / access["requests"], access["depth"])
+            self._put_metadata("ACCESS", access)
+
+        _adaptive_access.set_many({cache_key: access}, ADAPTIVE_STATE_TIMEOUT)
+
+    def _batch_size_costs(self, jump_ratio, depth):
+        """
+            Returns the expected cost of a request, in rows, for each possible
+            batch_size. A request costs the rows it fetches plus
+            adaptive_query_cost for every query.
+
+            A jump costs a whole batch. Reading page after page costs a batch
+            every batch_size pages if the batch cache is on, so a reader who
+            goes depth pages deep makes ceil(depth / batch_size) queries for
+            them, and fetches the rest of the last batch for nothing.
+        """
+        costs = {}
+        batch_size = 1
+        while batch_size <= self._adaptive_batch_size:
+            batch_rows = self.per_page * batch_size
+            jump_cost = batch_rows + self.adaptive_query_cost
+            if self._batch_cache_timeout:
+                batches = ceil(depth / float(batch_size))
+                sequential_cost = batches * jump_cost / depth
+            else:
+                sequential_cost = jump_cost
+            costs[batch_size] = jump_ratio * jump_cost + (1 - jump_ratio) * sequential_cost
+            batch_size *= 2
+        return costs
+
+    def _decide_batch_size(self, jump_ratio, depth):
+        costs = self._batch_size_costs(jump_ratio, max(depth, 1))
+        batch_size = min(sorted(costs), key=lambda size: costs[size])
+
+        decision = {
+            "time": int(time.time()),
+            "previous": self._batch_size,
+            "batch_size": batch_size,
+            "jump_ratio": round(jump_ratio, 3),
+            "depth": round(depth, 1),
+            "costs": dict((size, round(cost, 1)) for size, cost in costs.items()),
+        }
+        decisions = (self._get_metadata("BATCH_SIZE_DECISIONS") or [])[-9:]
+        self._put_metadata("BATCH_SIZE_DECISIONS", decisions + [decision])
+        self._put_metadata("BATCH_SIZE", batch_size)
+
+        # Takes effect from the next request on
+        self._batch_size = batch_size
+        _adaptive_batch_sizes.set_many({self.object_list.cache_key: batch_size}, ADAPTIVE_STATE_TIMEOUT)
+        self._observer.batch_size_decided(self, decision)
 
+    def batch_size_decisions(self):
+        """
+            Returns the last 10 batch_size decisions made for this query in
+            adaptive mode, oldest first. Each is a dict with the chosen and the
+            previous batch_size, the statistics it was based on and the cost of
+            every candidate.
+        """
+        self._load_metadata()
+        return self._get_metadata("BATCH_SIZE_DECISIONS") or []
+
+    def _page(self, number, batch=None):
+        """
+            batch - The (cursor, offset, results, next cursor, more objects)
+            of the batch query, if page_async() already ran it.
+        """
         nearest_page_with_cursor = self._find_nearest_page_with_cursor(number-1)
-        next_cursor = None
-        if self.object_list.supports_cursors:
-            #Store the cursor at the start of the NEXT batch
+        # The first page and the number of pages covered by the results
+        first_page, page_count = nearest_page_with_cursor, self._batch_size
+
+        cached_batch = self._get_cached_batch(nearest_page_with_cursor)
+        page_cursor = self._get_page_cursor(number-1)
+
+        # With a batch, page_async() already found that it's read that way
+        results_from_end = None
+        if cached_batch is None and not page_cursor and batch is None:
+            results_from_end = self._read_from_end(number)
+
+        results_from_keys = None
+        if cached_batch is None and self._key_list_timeout and batch is None:
+            results_from_keys = self._read_from_key_list(number)
+
+        if cached_batch is not None:
+            # Another page of this batch was served recently, no query needed
+            results, next_cursor, more_objects = cached_batch
+            offset = (number - 1 - nearest_page_with_cursor) * self.per_page
+            self._stats.batch_cache_hit = True
+        elif page_cursor:
+            # We have a cursor for exactly this page, so just read the page
+            first_page, page_count = number - 1, 1
+            offset = 0
+            self.object_list.starting_cursor(page_cursor)
+            results = self.object_list[:self.per_page]
             next_cursor = self.object_list.next_cursor
-            self._put_cursor(nearest_page_with_cursor + self._batch_size, next_cursor)
+            more_objects = self.object_list.more_objects
+            self._stats.cursor_hit = True
+            self._stats.queries += 1
+            self._stats.rows_fetched = len(results)
+        elif results_from_end is not None:
+            # The page is closer to the end than to any cursor, so it was
+            # read backwards from the end
+            first_page, page_count = number - 1, 1
+            offset = 0
+            results = results_from_end
+            next_cursor = None
+            more_objects = number * self.per_page < self._get_final_item()
+        elif results_from_keys is not None:
+            # Read by key from the materialized key list
+            first_page, page_count = number - 1, 1
+            offset = 0
+            results, more_objects = results_from_keys
+            next_cursor = None
+        elif batch is not None:
+            # Read by page_async(), the manager doesn't know the page cursors
+            cursor, offset, results, next_cursor, more_objects = batch
+            self._stats.queries += 1
+            self._stats.rows_fetched = len(results)
+            self._process_batch_hook(results, number-1, cursor, offset, next_cursor=next_cursor, more_objects=more_objects)
+        else:
+            cursor, offset = self._get_cursor_and_offset(number-1)
+
+            if cursor:
+                self.object_list.starting_cursor(cursor)
+                results = self.object_list[:(self.per_page * self._batch_size)]
+            else:
+                bottom = (self.per_page * nearest_page_with_cursor)
+                top = bottom + (self.per_page * self._batch_size)
+                #No cursor, so grab the full batch
+                results = self.object_list[bottom:top]
+
+            more_objects = self.object_list.more_objects
+            next_cursor = None
+            if self.object_list.supports_cursors:
+                next_cursor = self.object_list.next_cursor
+
+            self._stats.queries += 1
+            self._stats.rows_fetched = len(results)
+            self._process_batch_hook(results, number-1, cursor, offset, next_cursor=next_cursor, more_objects=more_objects)
+
+            if self.object_list.supports_cursors:
+                self._put_page_cursors(nearest_page_with_cursor, results)
+
+        #Store the cursor at the start of the NEXT batch. After a short batch
+        #it's the end of the query, inside a page rather than at its start.
+        if len(results) == self.per_page * page_count:
+            self._put_cursor(first_page + page_count, next_cursor, results)
 
         batch_result_count = len(results)
 
         actual_results = results[offset:offset + self.per_page]
+        self._stats.offset = offset
+        if self._stats.rows_fetched:
+            self._stats.rows_discarded = self._stats.rows_fetched - len(actual_results)
 
         if not actual_results:
             if number == 1 and self.allow_empty_first_page:
@@ -195,43 +1427,335 @@ class UnifiedPaginator(Paginator):
                 raise EmptyPage('That page contains no results')
 
         # Calculate known_page_count and cache it if necessary.
-        known_page_count = int(nearest_page_with_cursor + ceil(batch_result_count / float(self.per_page)))
-
-        if known_page_count >= self._get_known_page_count():
-            if next_cursor and self._readahead:
-                if self.object_list.contains_more_objects(next_cursor):
-                    known_page_count += 1
+        known_page_count = int(first_page + ceil(batch_result_count / float(self.per_page)))
+
+        if batch_result_count < page_count * self.per_page:
+            # A short batch is always the end, whatever the backend says
+            more_objects = False
+
+        if more_objects is not False and known_page_count >= self._get_known_page_count():
+            if more_objects is None and cached_batch is not None and self._get_final_page() == known_page_count:
+                # The query that filled the batch cache already found the end
+                more_objects = False
+            elif more_objects is None and next_cursor and self._readahead:
+                # The batch query couldn't tell, so we have to ask
+                self._stats.readahead_queries += 1
+                if batch is not None:
+                    more_objects = self._readahead_while_flushing(next_cursor)
                 else:
-                    self._put_final_page(known_page_count)
-            elif batch_result_count == self._batch_size * self.per_page:
+                    more_objects = self.object_list.contains_more_objects(next_cursor)
+
+            if more_objects is not False:
                 # If we got back exactly the right amount, we assume there is at least
                 # one more page.
-                known_page_count += 1
+                self._put_known_page_count(known_page_count + 1)
+
+        # Calculate known_item_count and if it's the last item
+        known_item_count = int(first_page * self.per_page + batch_result_count)
 
+        if more_objects is False:
+            # The end, even if the counts went further before objects were deleted
+            self._put_final_page(known_page_count)
             self._put_known_page_count(known_page_count)
+            self._put_known_items_count(known_item_count)
+            self._put_final_item(known_item_count, next_cursor)
+        elif known_item_count > self._get_known_items_count():
+            self._put_known_items_count(known_item_count)
 
-        # Calculate known_item_count and if it's the last item
-        known_item_count = int(nearest_page_with_cursor * self.per_page + batch_result_count)
+        if self._should_prefetch(number, first_page, page_count, next_cursor):
+            self._start_prefetch(first_page + page_count, next_cursor)
 
+        return UnifiedPage(actual_results, number, self, self._snapshot())
+
+    def _iter_chunks(self, chunk_size=None):
+        """
+            Yields the objects of the query in lists of chunk_size, one query
+            each, continuing from the end cursor of the previous chunk. The
+            cursors passed and the known counts are cached on the way, with a
+            single cache write per chunk.
+        """
+        batch_items = self.per_page * self._batch_size
+        chunk_size = chunk_size or batch_items
+        if chunk_size % batch_items:
+            raise ValueError('chunk_size must be a multiple of per_page * batch_size (%d)' % batch_items)
+
+        # A copy, so the crawl doesn't disturb the cursors of page() calls
+        manager = copy.copy(self.object_list)
+        cursor_pages = 1 if self._store_page_cursors else self._batch_size
+        manager.cursor_step = self.per_page * cursor_pages
+
+        first_page, cursor = 0, None
+        while True:
+            self._pending_writes = {}
+            try:
+                self._load_metadata()
+                if manager.supports_cursors:
+                    if cursor:
+                        manager.starting_cursor(cursor)
+                    chunk = manager[:chunk_size]
+                    for i, page_cursor in enumerate(manager.page_cursors):
+                        self._put_cursor(
+                            first_page + (i + 1) * cursor_pages, page_cursor,
+                            chunk, (i + 1) * cursor_pages * self.per_page
+                        )
+                    cursor = manager.next_cursor
+                    if len(chunk) % manager.cursor_step == 0:
+                        # A short chunk ends inside a page, not on a boundary
+                        self._put_cursor(first_page + len(chunk) // self.per_page, cursor, chunk)
+                else:
+                    bottom = first_page * self.per_page
+                    chunk = manager[bottom:bottom + chunk_size]
+
+                more_objects = manager.more_objects
+                if len(chunk) < chunk_size:
+                    more_objects = False
+                elif more_objects is None and cursor and self._readahead:
+                    more_objects = manager.contains_more_objects(cursor)
+
+                self._record_chunk(first_page, len(chunk), more_objects, cursor)
+            finally:
+                self._flush_pending_writes()
+
+            if chunk:
+                yield chunk
+            if not chunk or more_objects is False:
+                return
+            first_page += chunk_size // self.per_page
+
+    def _record_chunk(self, first_page, count, more_objects, end_cursor=None):
+        """ Updates the known counts after reading count objects from first_page on """
+        known_item_count = first_page * self.per_page + count
+        known_page_count = int(first_page + ceil(count / float(self.per_page)))
+
+        if more_objects is False:
+            self._put_final_page(known_page_count)
+            self._put_final_item(known_item_count, end_cursor)
+        else:
+            known_page_count += 1
+
+        if known_page_count > self._get_known_page_count():
+            self._put_known_page_count(known_page_count)
         if known_item_count > self._get_known_items_count():
             self._put_known_items_count(known_item_count)
 
-        if batch_result_count < (self.per_page * self._batch_size):
-            # No need to read ahead for one item, it won't be 100% accurate anyway.
-            self._put_final_item(known_item_count)
+    def iter_objects(self, chunk_size=None):
+        """
+            Yields every object of the query, for exports and batch jobs. The
+            objects are read chunk_size (by default a batch) at a time,
+            following the cursors from chunk to chunk, so every chunk costs a
+            single query and only one chunk is held in memory. The cursors
+            and counts found on the way are cached for page() to use.
+        """
+        for chunk in self._iter_chunks(chunk_size):
+            for obj in chunk:
+                yield obj
+
+    def iter_pages(self, chunk_size=None):
+        """
+            Yields every page of the query in order, read the same way as
+            iter_objects().
+        """
+        number = 1
+        for chunk in self._iter_chunks(chunk_size):
+            for i in xrange(0, len(chunk), self.per_page):
+                yield UnifiedPage(chunk[i:i + self.per_page], number, self)
+                number += 1
+
+        if number == 1 and self.allow_empty_first_page:
+            yield UnifiedPage([], 1, self)
+
+    @property
+    def batch_items(self):
+        """ The number of objects between two cached batch cursors """
+        return self.per_page * self._batch_size
 
-        return UnifiedPage(actual_results, number, self)
+    def warm_start(self, tail_only=False):
+        """
+            Returns the (0-based page, cursor) a cursor warmer continues from:
+            the highest batch cursor still cached at or below where the last
+            warming stopped, or below the known end with tail_only.
+        """
+        self._load_metadata()
+        start_page = self._get_metadata("WARMED_PAGE") or 0
+        if tail_only:
+            known_pages = self._get_final_page() or self._get_known_page_count() or 1
+            start_page = max(start_page, self._find_nearest_page_with_cursor(known_pages - 1))
+
+        self._prefetch([str(boundary) for boundary in self._lower_cursor_boundaries(start_page)])
+        return self._nearest_cached_cursor(start_page)
+
+    def store_warmed_cursors(self, page, cursors, remaining=None):
+        """
+            Caches the batch cursors a warmer walked after the given 0-based
+            page, and the counts they prove, with a single cache write.
+            remaining is the number of objects after the last cursor once the
+            walk reached the end of the query. Returns the page of the last
+            cursor.
+        """
+        self._pending_writes = {}
+        try:
+            # Reloaded so page() calls made meanwhile aren't overwritten
+            self._load_metadata()
+            for cursor in cursors:
+                page += self._batch_size
+                self._put_cursor(page, cursor)
+
+            if remaining is None:
+                self._put_metadata("WARMED_PAGE", page)
+                self._record_chunk(0, page * self.per_page, None)
+            else:
+                self._put_metadata("WARMED_PAGE", None)
+                self._record_chunk(page, remaining, False)
+        finally:
+            self._flush_pending_writes()
+        return page
+
+    def _count_objects(self):
+        """
+            Counts the objects of the query. The objects before the highest
+            cached batch cursor aren't counted again, only the ones after it,
+            so refreshing the count of a growing list stays cheap.
+        """
+        start_page, cursor = 0, None
+        if self.object_list.supports_cursors:
+            self._load_metadata()
+            known_pages = self._get_known_page_count() or 1
+            page_with_cursor = self._find_nearest_page_with_cursor(known_pages - 1)
+            self._prefetch([str(boundary) for boundary in self._lower_cursor_boundaries(page_with_cursor)])
+            start_page, cursor = self._nearest_cached_cursor(page_with_cursor)
+
+        return start_page * self.per_page + self.object_list.count_from(cursor)
+
+    def _snapshot(self):
+        """ A PageSnapshot of the counts as they are now """
+        return PageSnapshot(
+            self._get_known_page_count(),
+            self._get_known_items_count(),
+            self._get_final_page(),
+            self._get_final_item(),
+            self._batch_size,
+            self._prefetched.get("COUNT"),
+        )
+
+    def _get_cached_count(self):
+        """ Returns the cached (count, time counted) or None """
+        self._prefetch(["COUNT"])
+        return self._prefetched.get("COUNT")
+
+    def _detached_copy(self):
+        """ A copy of the paginator which can be used from another thread """
+        paginator = copy.copy(self)
+        paginator.object_list = copy.copy(self.object_list)
+        paginator._metadata = None
+        paginator._pending_writes = None
+        paginator._prefetched = {}
+        paginator._generation = None
+        paginator._stats = None
+        return paginator
+
+    def _start_count(self):
+        """ Starts counting in the background, unless a count is running already """
+        key = self._make_key("COUNTING")
+        with _prefetches_lock:
+            if key in _counts_in_flight:
+                return None
+            _counts_in_flight.add(key)
+
+        future = None
+        leased = False
+        try:
+            leased = cache.add(key, True, COUNT_LEASE_TIMEOUT)
+            if leased:
+                future = background_pool.try_submit(self._detached_copy().refresh_count)
+        finally:
+            if future is None:
+                if leased:
+                    # No thread was free, let the next request try
+                    cache.delete(key)
+                with _prefetches_lock:
+                    _counts_in_flight.discard(key)
+
+        if future is not None:
+            future.add_callback(self._finish_count, key)
+        return future
+
+    def _finish_count(self, key):
+        try:
+            cache.delete(key)
+        finally:
+            with _prefetches_lock:
+                _counts_in_flight.discard(key)
+
+    def refresh_count(self, background=False):
+        """
+            Counts the objects and caches the count. With background=True it's
+            counted in a background thread (if one is free), and the future is
+            returned instead of the count.
+        """
+        if background:
+            return self._start_count()
+
+        count = self._count_objects()
+        self._cache_set(self._make_key("COUNT"), (count, time.time()))
+        return count
+
+    def _current_estimate(self):
+        """ The CountEstimate from what is cached, and whether it needs a count """
+        return _estimate_count(
+            self._get_final_item(), self._get_known_items_count(), self._get_cached_count(), self.count_max_age
+        )
+
+    def count_estimate(self):
+        """
+            Returns a CountEstimate without querying the datastore or starting
+            a count. It's exact if the last page was reached or a count is
+            cached that isn't older than count_max_age. Otherwise it's the
+            number of objects known to exist so far (or the stale count if
+            that is higher). ensure_count() keeps the count fresh.
+        """
+        return self._current_estimate()[0]
+
+    def ensure_count(self):
+        """
+            Starts counting in the background if the count isn't exact, i.e.
+            the end wasn't reached and nothing was counted in the last
+            count_max_age seconds. Returns the future, or None if no count was
+            started.
+        """
+        if not self._current_estimate()[1]:
+            return None
+        return self.refresh_count(background=True)
 
     def _get_count(self):
-        raise NotImplemented("Not available in %s" % self.__class__.__name__)
+        """
+            The number of objects, as count_estimate() has it. Never counts
+            right away: if it isn't exact, a count is started in the
+            background and the estimate returned meanwhile.
+        """
+        estimate, stale = self._current_estimate()
+        if stale:
+            self.refresh_count(background=True)
+        return estimate.count
+    count = property(_get_count)
 
     def _get_num_pages(self):
-        raise NotImplemented("Not available in %s" % self.__class__.__name__)
+        count = self._get_count()
+        if count == 0 and not self.allow_empty_first_page:
+            return 0
+        return int(ceil(max(count, 1) / float(self.per_page)))
+    num_pages = property(_get_num_pages)
 
 
 class UnifiedPage(Page):
-    def __init__(self, object_list, number, paginator):
+    def __init__(self, object_list, number, paginator, snapshot=None):
+        """
+            snapshot - The PageSnapshot the page renders from, by default one
+            of the paginator's counts as they are now.
+        """
         super(UnifiedPage, self).__init__(object_list, number, paginator)
+        if snapshot is None:
+            snapshot = paginator._snapshot()
+        self.snapshot = snapshot
 
     def __repr__(self):
         """ Overwrite paginator's repr, so no Exception gets thrown
@@ -240,7 +1764,7 @@ class UnifiedPage(Page):
         return '<Page %s>' % (self.number)
 
     def has_next(self):
-        return self.number < self.paginator._get_known_page_count()
+        return self.number < self.snapshot.known_page_count
 
     def start_index(self):
         """ Override to prevent returning 0 """
@@ -254,13 +1778,27 @@ class UnifiedPage(Page):
             return self.number * self.paginator.per_page
         else:
             # Special case for a last page when the page has less items then a per_page value
-            final_item_count = self.paginator._get_final_item()
+            final_item_count = self.snapshot.final_item
             if not final_item_count:
-                return self.paginator._get_known_items_count()
+                return self.snapshot.known_items_count
             return final_item_count
 
     def final_page_visible(self):
-        return self.paginator._get_final_page() in self.available_pages()
+        return self.snapshot.final_page in self.available_pages()
+
+    def _estimate_count(self):
+        snapshot = self.snapshot
+        return _estimate_count(
+            snapshot.final_item, snapshot.known_items_count, snapshot.cached_count, self.paginator.count_max_age
+        )
+
+    def count_estimate(self):
+        """
+            Like the paginator's count_estimate(), but from the snapshot. Has
+            no side effects, with count_on_page set page() already started a
+            count if it was needed.
+        """
+        return self._estimate_count()[0]
 
     def available_pages(self, limit_to_batch_size=True):
         """
@@ -279,11 +1817,11 @@ class UnifiedPage(Page):
             this will generally be the same for the upper count, but the results
             will always start at 1.
         """
-        min_page = (self.number - self.paginator._batch_size) if limit_to_batch_size else 1
+        min_page = (self.number - self.snapshot.batch_size) if limit_to_batch_size else 1
         if min_page < 1:
             min_page = 1
 
-        max_page = min(self.number + self.paginator._batch_size, self.paginator._get_known_page_count())
+        max_page = min(self.number + self.snapshot.batch_size, self.snapshot.known_page_count)
         return list(xrange(min_page, max_page + 1))
 
     def __repr__(self):
@@ -305,8 +1843,11 @@ class DjangoNonrelPaginator(UnifiedPaginator):
 class GaeNdbPaginator(UnifiedPaginator):
     """
         Paginator using GAE's NDB.
+
+        keys_only - Run the batch queries keys only and load just the entities
+        of the requested page, see GaeNdbModelManager.
     """
     def __init__(self, query, *args, **kwargs):
         from object_managers.ndb_api import GaeNdbModelManager
-        object_list = GaeNdbModelManager(query)
+        object_list = GaeNdbModelManager(query, keys_only=kwargs.pop("keys_only", False))
         super(GaeNdbPaginator, self).__init__(object_list, *args, **kwargs)
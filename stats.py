@@ -0,0 +1,87 @@
+from collections import deque
+
+
+class PageStats(object):
+    """
+        What a single UnifiedPaginator.page() call did.
+
+        cursor_hit - True if the batch (or page) cursor came from the cache,
+        False if it had to be walked to, None if no cursor was needed.
+
+        coalesced - True if another caller's queries for the same batch were
+        waited for instead of querying.
+    """
+    __slots__ = (
+        "number",
+        "cursor_hit",
+        "batch_cache_hit",
+        "coalesced",
+        "offset",
+        "keys_skipped",
+        "queries",
+        "rows_fetched",
+        "rows_discarded",
+        "readahead_queries",
+        "cache_reads",
+        "local_cache_hits",
+        "cache_writes",
+        "wall_time",
+    )
+
+    def __init__(self, number):
+        self.number = number
+        self.cursor_hit = None
+        self.batch_cache_hit = False
+        self.coalesced = False
+        self.offset = 0
+        self.keys_skipped = 0
+        self.queries = 0
+        self.rows_fetched = 0
+        self.rows_discarded = 0
+        self.readahead_queries = 0
+        self.cache_reads = 0
+        self.local_cache_hits = 0
+        self.cache_writes = 0
+        self.wall_time = 0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return '<PageStats %s>' % self.as_dict()
+
+
+class PaginatorObserver(object):
+    """
+        Receives the PageStats of every page() call. This one does nothing,
+        subclass it and pass an instance as the paginator's observer.
+    """
+    def page_served(self, paginator, stats):
+        pass
+
+    def batch_size_decided(self, paginator, decision):
+        """ Called with every decision of a paginator with adaptive_batch_size """
+        pass
+
+
+class StatsCollector(PaginatorObserver):
+    """
+        Keeps the stats of the last maxlen page() calls in memory, per query.
+    """
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self.stats = {}
+
+    def page_served(self, paginator, stats):
+        key = paginator.object_list.cache_key
+        if key not in self.stats:
+            self.stats[key] = deque(maxlen=self.maxlen)
+        self.stats[key].append(stats)
+
+    def totals(self, cache_key):
+        """ Sums up the stats collected for a query, booleans count the Trues """
+        collected = self.stats.get(cache_key, ())
+        totals = {"pages": len(collected)}
+        for name in PageStats.__slots__[1:]:
+            totals[name] = sum(getattr(stats, name) or 0 for stats in collected)
+        return totals
@@ -21,18 +21,17 @@ def paginator_querystring(context, page_number, page_name):
 
 @register.simple_tag
 def paginator_object_count(page):
-    """ Calculate approximate (quick) or the exact (if the last page was reached) count of how many objects are in
-        full object_list for pagination count """
-    if page.paginator.__class__.__name__ == "DjangoNonrelPaginator" and \
-            page.__class__.__name__ == "UnifiedPage":
-        total_item_count = page.paginator._get_final_item()
+    """ Calculate approximate (quick) or the exact (if the last page was reached or the paginator has a recent
+        count cached) count of how many objects are in full object_list for pagination count """
+    if hasattr(page, "count_estimate"):
+        # From the counts the page was served with, no cache reads
+        estimate = page.count_estimate()
 
-        if not total_item_count:
+        if not estimate.exact:
             more_than_string = 'more than'
-            return "%s %d" % (more_than_string,
-                page.paginator._get_known_items_count())
+            return "%s %d" % (more_than_string, estimate.count)
 
-        return total_item_count
+        return estimate.count
 
     # Normal Django Paginator.
     return page.count()
@@ -1,15 +1,31 @@
+import gc
+import threading
+
 from google.appengine.ext import ndb
 
+from django.core.cache import cache
 from django.db import models
 from django.test import TestCase
 
 import mock
 
+from potatopage import invalidation
+from potatopage.local_cache import local_cache
+from potatopage.object_managers.gae_db import merged_in_query
+from potatopage.object_managers.in_memory import InMemoryObjectManager
+from potatopage.object_managers.merged import MergedObjectManager
+from potatopage.object_managers.ndb_api import LazyEntityList
 from potatopage.paginator import (
     DjangoNonrelPaginator,
     GaeNdbPaginator,
-    EmptyPage
+    UnifiedPaginator,
+    EmptyPage,
+    flush_model_cache,
+    get_pages
 )
+from potatopage.stats import StatsCollector
+from potatopage.utils import background_pool
+from potatopage.warmer import warm_cursors
 
 
 class DjangoNonrelPaginationModel(models.Model):
@@ -53,7 +69,8 @@ class DjangoNonrelPaginatorTests(TestCase):
         paginator.page(3)
 
         self.assertFalse(paginator.has_cursor_for_page(2))
-        self.assertFalse(paginator.has_cursor_for_page(3))
+        #Stored while skipping ahead to the batch
+        self.assertTrue(paginator.has_cursor_for_page(3))
         self.assertTrue(paginator.has_cursor_for_page(5))
 
         paginator.page(1)
@@ -70,6 +87,89 @@ class DjangoNonrelPaginatorTests(TestCase):
         self.assertEqual(2, len(page3.object_list))
         self.assertEqual(10, page3.object_list[0].field1)
 
+    def test_cache_round_trips(self):
+        paginator = DjangoNonrelPaginator(DjangoNonrelPaginationModel.objects.all().order_by("field1"), 5, batch_size=2)
+        paginator.page(1)
+
+        with mock.patch("potatopage.paginator.cache", wraps=cache) as mock_cache:
+            page3 = paginator.page(3)
+            page3.has_next()
+            page3.end_index()
+            page3.available_pages()
+            page3.final_page_visible()
+
+        calls = [call[0] for call in mock_cache.method_calls]
+        # A single bulk read and a single bulk write for the whole page view
+        self.assertEqual(["get_many", "set_many"], calls)
+        self.assertEqual(10, page3.object_list[0].field1)
+
+    def test_batch_cache(self):
+        paginator = DjangoNonrelPaginator(DjangoNonrelPaginationModel.objects.all().order_by("field1"), 5, batch_size=2, batch_cache_timeout=60)
+        paginator.page(1)
+
+        with mock.patch("potatopage.object_managers.gae_db.DjangoNonrelManager.__getitem__") as mock_obj:
+            #Same batch as page 1, so it should come from the cache
+            page2 = paginator.page(2)
+            self.assertFalse(mock_obj.called)
+
+        self.assertEqual(5, len(page2.object_list))
+        self.assertEqual(5, page2.object_list[0].field1)
+        self.assertTrue(page2.has_next())
+
+    def test_resume_from_lower_cursor(self):
+        paginator = DjangoNonrelPaginator(DjangoNonrelPaginationModel.objects.all().order_by("field1"), 2)
+        paginator.page(2)
+        self.assertTrue(paginator.has_cursor_for_page(3))
+
+        manager = paginator.object_list
+        with mock.patch.object(manager, "cursors_ahead", wraps=manager.cursors_ahead) as mock_obj:
+            page5 = paginator.page(5)
+            #Should walk the 2 batches between the cursor for page 3 and page 5
+            self.assertEqual((2, 2), mock_obj.call_args[0])
+            self.assertTrue(mock_obj.call_args[1]["start_cursor"])
+
+        self.assertEqual(8, page5.object_list[0].field1)
+        #The cursor passed on the way was stored too
+        self.assertTrue(paginator.has_cursor_for_page(4))
+
+    def test_prefetch(self):
+        paginator = DjangoNonrelPaginator(DjangoNonrelPaginationModel.objects.all().order_by("field1"), 5, batch_cache_timeout=60, prefetch_distance=1)
+        paginator.page(1)
+
+        #The second batch is being fetched in the background
+        self.assertEqual(1, len(paginator._prefetches))
+        for future, key in paginator._prefetches:
+            future.wait()
+
+        with mock.patch("potatopage.object_managers.gae_db.DjangoNonrelManager.__getitem__") as mock_obj:
+            page2 = paginator.page(2)
+            self.assertFalse(mock_obj.called)
+
+        self.assertEqual(5, page2.object_list[0].field1)
+
+    def test_cache_key(self):
+        queryset = DjangoNonrelPaginationModel.objects.filter(field1__gte=1).filter(field1__lte=5).order_by("field1")
+        manager = DjangoNonrelPaginator(queryset, 5).object_list
+        other_queryset = DjangoNonrelPaginationModel.objects.filter(field1__lte=5, field1__gte=1).order_by("field1")
+        other_manager = DjangoNonrelPaginator(other_queryset, 5).object_list
+
+        #Same filters in a different order give the same, short key
+        self.assertEqual(manager.cache_key, other_manager.cache_key)
+        self.assertTrue(manager.cache_key.startswith(DjangoNonrelPaginationModel._meta.db_table))
+        self.assertTrue(len(manager.cache_key) < 100)
+
+        descending_manager = DjangoNonrelPaginator(queryset.order_by("-field1"), 5).object_list
+        self.assertNotEqual(manager.cache_key, descending_manager.cache_key)
+
+        #Nodes which aren't lookups get a key too
+        empty_manager = DjangoNonrelPaginator(queryset.none(), 5).object_list
+        self.assertNotEqual(manager.cache_key, empty_manager.cache_key)
+
+        extra_queryset = queryset.extra(where=["field1 != %s"], params=[3])
+        extra_manager = DjangoNonrelPaginator(extra_queryset, 5).object_list
+        self.assertEqual(extra_manager.cache_key, DjangoNonrelPaginator(extra_queryset.all(), 5).object_list.cache_key)
+        self.assertNotEqual(manager.cache_key, extra_manager.cache_key)
+
     def test_in_query(self):
         paginator = DjangoNonrelPaginator(DjangoNonrelPaginationModel.objects.filter(field1__in=xrange(12)).all().order_by("field1"), 5)
 
@@ -96,6 +196,17 @@ class DjangoNonrelPaginatorTests(TestCase):
 
         self.assertRaises(EmptyPage, paginator.page, 4)
 
+    def test_merged_in_query(self):
+        queryset = DjangoNonrelPaginationModel.objects.all().order_by("field1")
+        paginator = UnifiedPaginator(merged_in_query(queryset, "field1", [1, 3, 4, 7, 8, 11]), 2)
+        self.assertTrue(paginator.object_list.supports_cursors)
+
+        self.assertEqual([1, 3], [obj.field1 for obj in paginator.page(1).object_list])
+        page3 = paginator.page(3)
+        self.assertEqual([8, 11], [obj.field1 for obj in page3.object_list])
+        self.assertFalse(page3.has_next())
+        self.assertTrue(paginator.has_cursor_for_page(3))
+
     def test_total_items_count(self):
         """ Test total items count 
             We don't know the real count until we reach the last page 
@@ -131,6 +242,535 @@ class DjangoNonrelPaginatorTests(TestCase):
         self.assertEqual(page.paginator._get_known_items_count(), 2 * per_page + 2)  # exact number (from cache)
 
 
+class InMemoryPaginatorTests(TestCase):
+    def test_basic_usage(self):
+        paginator = UnifiedPaginator(InMemoryObjectManager(range(12)), 5)
+
+        page1 = paginator.page(1)
+        self.assertEqual(range(5), page1.object_list)
+        self.assertTrue(page1.has_next())
+        self.assertEqual([1, 2], page1.available_pages())
+
+        page3 = paginator.page(3)
+        self.assertEqual([10, 11], page3.object_list)
+        self.assertFalse(page3.has_next())
+        self.assertEqual(12, page3.end_index())
+
+        self.assertRaises(EmptyPage, paginator.page, 4)
+
+        #Django's arguments can still be passed positionally
+        paginator = UnifiedPaginator(InMemoryObjectManager(range(12)), 5, 1, True, 0, False)
+        self.assertEqual(0, paginator.orphans)
+        self.assertFalse(paginator.allow_empty_first_page)
+        self.assertEqual(200, paginator._batch_cache_max_items)
+
+    def test_observer(self):
+        collector = StatsCollector()
+        manager = InMemoryObjectManager(range(12))
+        paginator = UnifiedPaginator(manager, 5, batch_size=2, observer=collector)
+
+        paginator.page(2)
+        stats = collector.stats[manager.cache_key][-1]
+        self.assertEqual(2, stats.number)
+        self.assertEqual(10, stats.rows_fetched)
+        self.assertEqual(5, stats.rows_discarded)
+        self.assertEqual(5, stats.offset)
+        #The batch query already told us whether there is more
+        self.assertEqual(0, stats.readahead_queries)
+        self.assertEqual(1, stats.cache_reads)
+        self.assertEqual(1, stats.cache_writes)
+
+        paginator.page(3)
+        stats = collector.stats[manager.cache_key][-1]
+        self.assertTrue(stats.cursor_hit)
+        self.assertEqual(2, stats.rows_fetched)
+        self.assertEqual(2, collector.totals(manager.cache_key)["pages"])
+
+    def test_flush_cache(self):
+        paginator = UnifiedPaginator(InMemoryObjectManager(range(12)), 5)
+        paginator.page(2)
+        self.assertTrue(paginator.has_cursor_for_page(3))
+
+        with mock.patch("potatopage.paginator.cache", wraps=cache) as mock_cache:
+            paginator.flush_cache()
+
+        #A single increment, however many pages are cached
+        self.assertEqual(["incr"], [call[0] for call in mock_cache.method_calls])
+        self.assertFalse(paginator.has_cursor_for_page(3))
+        self.assertEqual(None, paginator._get_known_page_count())
+
+    def test_generation_never_expires(self):
+        paginator = UnifiedPaginator(InMemoryObjectManager(range(12)), 5)
+        with mock.patch("potatopage.paginator.cache", wraps=cache) as mock_cache:
+            paginator.page(1)
+        mock_cache.add.assert_called_once_with(paginator._make_key("GENERATION"), paginator._generation[0], None)
+
+    def test_generation_evicted_while_starting(self):
+        paginator = UnifiedPaginator(InMemoryObjectManager(range(12)), 5)
+
+        #Another request added the generation, and it got evicted before we read it
+        with mock.patch("potatopage.paginator.cache.add", return_value=False):
+            paginator.page(1)
+        self.assertFalse(None in paginator._generation)
+
+    def test_pages_near_the_end_are_read_backwards(self):
+        collector = StatsCollector()
+        manager = InMemoryObjectManager(range(95))
+        paginator = UnifiedPaginator(manager, 10, observer=collector)
+        paginator.page(10)
+
+        #Lose the cursors, but not the known end of the query
+        cache.delete_many([paginator._make_key(str(i)) for i in xrange(1, 10)])
+
+        page9 = paginator.page(9)
+        self.assertEqual(range(80, 90), page9.object_list)
+        self.assertTrue(page9.has_next())
+        stats = collector.stats[manager.cache_key][-1]
+        self.assertEqual(5, stats.keys_skipped)
+        #Checking the end, skipping from it and reading the page
+        self.assertEqual(3, stats.queries)
+
+        page10 = paginator.page(10)
+        self.assertEqual(range(90, 95), page10.object_list)
+        self.assertFalse(page10.has_next())
+
+        #Objects added after the known end aren't skipped over
+        for i in xrange(95, 105):
+            manager.add(i)
+        cache.delete_many([paginator._make_key(str(i)) for i in xrange(1, 11)])
+        self.assertEqual(range(80, 90), paginator.page(9).object_list)
+        self.assertEqual(range(100, 105), paginator.page(11).object_list)
+
+    def test_iter_objects(self):
+        manager = InMemoryObjectManager(range(95))
+        paginator = UnifiedPaginator(manager, 10)
+
+        self.assertEqual(range(95), list(paginator.iter_objects(chunk_size=30)))
+        #One query per chunk
+        self.assertEqual(4, manager.queries)
+        self.assertRaises(ValueError, list, paginator.iter_objects(chunk_size=25))
+
+        #The crawl cached the cursors and the counts
+        self.assertTrue(paginator.has_cursor_for_page(7))
+        self.assertEqual(10, paginator._get_final_page())
+
+        pages = list(paginator.iter_pages())
+        self.assertEqual(10, len(pages))
+        self.assertEqual(range(90, 95), pages[-1].object_list)
+        self.assertTrue(pages[0].has_next())
+        self.assertFalse(pages[-1].has_next())
+
+        #The end of a list that isn't a multiple of per_page isn't taken for a page boundary
+        for crawl in (lambda paginator: list(paginator.iter_objects(chunk_size=30)), lambda paginator: list(paginator.iter_pages())):
+            paginator = UnifiedPaginator(InMemoryObjectManager(range(95)), 10)
+            crawl(paginator)
+            self.assertEqual(range(90, 95), paginator.page(10).object_list)
+
+    def test_cursor_lookback(self):
+        collector = StatsCollector()
+        manager = InMemoryObjectManager(range(100))
+        paginator = UnifiedPaginator(manager, 10, observer=collector)
+        paginator.page(3)
+
+        #Only the page's own cursor is read with the bulk read
+        with mock.patch("potatopage.paginator.cache", wraps=cache) as mock_cache:
+            paginator.page(4)
+            self.assertEqual(1, mock_cache.get_many.call_count)
+
+        #The ones below it only if it's missing
+        with mock.patch("potatopage.paginator.cache", wraps=cache) as mock_cache:
+            self.assertEqual(range(50, 60), paginator.page(6).object_list)
+            self.assertEqual(2, mock_cache.get_many.call_count)
+        self.assertEqual(10, collector.stats[manager.cache_key][-1].keys_skipped)
+
+    def test_warm_cursors(self):
+        manager = InMemoryObjectManager(range(95))
+        paginator = UnifiedPaginator(manager, 10, batch_size=2)
+
+        result = warm_cursors(paginator, max_batches=2, batches_per_query=1)
+        self.assertEqual({"batches": 2, "queries": 2, "complete": False}, result)
+        self.assertTrue(paginator.has_cursor_for_page(5))
+        self.assertFalse(paginator.has_cursor_for_page(7))
+
+        #Continues where the last run stopped
+        result = warm_cursors(paginator)
+        self.assertEqual(2, result["batches"])
+        self.assertTrue(result["complete"])
+        self.assertTrue(paginator.has_cursor_for_page(9))
+        self.assertEqual(10, paginator._get_final_page())
+        self.assertEqual(95, paginator._get_final_item())
+
+        #Appended objects are found by walking just the tail
+        for i in xrange(95, 130):
+            manager.add(i)
+        result = warm_cursors(paginator, tail_only=True)
+        self.assertEqual(2, result["queries"])
+        self.assertEqual(130, paginator._get_final_item())
+        self.assertTrue(paginator.has_cursor_for_page(13))
+
+    def test_adaptive_batch_size(self):
+        manager = InMemoryObjectManager(range(500))
+        paginator = UnifiedPaginator(manager, 10, batch_cache_timeout=60, adaptive_batch_size=8)
+        paginator.adaptive_interval = 20
+        self.assertRaises(ValueError, UnifiedPaginator, manager, 10, batch_size=3, adaptive_batch_size=8)
+
+        #Reading page after page makes bigger batches worth it
+        for number in xrange(1, 41):
+            paginator.page(number)
+        decision = paginator.batch_size_decisions()[-1]
+        self.assertEqual(8, decision["batch_size"])
+        self.assertEqual(0, decision["jump_ratio"])
+        self.assertEqual(8, paginator._batch_size)
+
+        #The access statistics are only cached along with a decision
+        with mock.patch("potatopage.paginator.cache.set_many", wraps=cache.set_many) as set_many:
+            paginator.page(2)
+        written = [key for call in set_many.call_args_list for key in call[0][0]]
+        self.assertFalse(paginator._make_key("METADATA_ACCESS") in written)
+        self.assertTrue(paginator._get_metadata("ACCESS"))
+
+        #Other paginators for the query follow the decision
+        other_paginator = UnifiedPaginator(manager, 10, batch_cache_timeout=60, adaptive_batch_size=8)
+        other_paginator.adaptive_interval = 20
+        self.assertEqual(range(400, 410), other_paginator.page(41).object_list)
+        self.assertEqual(8, other_paginator._batch_size)
+
+        #Jumping around makes them too expensive
+        for number in [3, 30, 12, 45, 7, 22, 38, 1, 17, 49] * 2:
+            other_paginator.page(number)
+        decision = other_paginator.batch_size_decisions()[-1]
+        self.assertEqual(8, decision["previous"])
+        self.assertTrue(decision["batch_size"] < 8)
+
+    def test_metadata_entries(self):
+        manager = InMemoryObjectManager(range(50))
+        paginator = UnifiedPaginator(manager, 10, adaptive_batch_size=4, track_changes=True)
+        paginator.page(3)
+
+        #Serving a page again leaves the counts alone
+        with mock.patch("potatopage.paginator.cache.set_many", wraps=cache.set_many) as set_many:
+            paginator.page(3)
+        written = [key for call in set_many.call_args_list for key in call[0][0]]
+        self.assertFalse([key for key in written if "|METADATA_" in key])
+
+        #Another request's boundaries don't overwrite what this one learnt
+        other_paginator = UnifiedPaginator(manager, 10, adaptive_batch_size=4, track_changes=True)
+        other_paginator._load_metadata()
+        paginator.page(5)
+        other_paginator._put_metadata("BOUNDARIES", {})
+        paginator._load_metadata()
+        self.assertEqual(5, paginator._get_final_page())
+
+        #Nor does writing one of the values read with every page undo the others
+        other_paginator._put_metadata("BATCH_SIZE", 2)
+        paginator._load_metadata()
+        self.assertEqual(5, paginator._get_final_page())
+        self.assertEqual(50, paginator._get_final_item())
+
+    def test_coalesce_concurrent_page_loads(self):
+        collector = StatsCollector()
+        managers = [InMemoryObjectManager(range(200), latency=0.05, cache_key="coalesced") for i in xrange(5)]
+
+        def load_page(manager):
+            paginator = UnifiedPaginator(manager, 10, batch_size=2, batch_cache_timeout=60, coalesce_timeout=5, observer=collector)
+            paginator.page(8)
+
+        threads = [threading.Thread(target=load_page, args=(manager,)) for manager in managers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        #One caller walked to the batch and queried it, the others waited for it
+        self.assertEqual(2, sum(manager.queries for manager in managers))
+        self.assertEqual(4, sum(stats.coalesced for stats in collector.stats["coalesced"]))
+        self.assertEqual(5, len(collector.stats["coalesced"]))
+
+    def test_merged_object_manager(self):
+        #Multiples of 2 are in two of the sub-queries
+        sub_managers = [InMemoryObjectManager(xrange(i, 60, 3)) for i in xrange(3)]
+        sub_managers.append(InMemoryObjectManager(xrange(0, 60, 2)))
+        collector = StatsCollector()
+        manager = MergedObjectManager(sub_managers, cmp)
+        paginator = UnifiedPaginator(manager, 5, batch_size=2, observer=collector)
+
+        self.assertEqual(range(5), paginator.page(1).object_list)
+        self.assertEqual(range(35, 40), paginator.page(8).object_list)
+        self.assertTrue(paginator.has_cursor_for_page(9))
+        #Without a single query walk, a skip_ahead() per batch and the batch query
+        self.assertEqual(3, collector.stats[manager.cache_key][-1].queries)
+
+        #From the composite cursor, one query per sub-query
+        queries = sum(manager.queries for manager in sub_managers)
+        page9 = paginator.page(9)
+        self.assertEqual(range(40, 45), page9.object_list)
+        self.assertEqual(queries + 4, sum(manager.queries for manager in sub_managers))
+
+        self.assertFalse(paginator.page(12).has_next())
+        self.assertRaises(EmptyPage, paginator.page, 13)
+
+    def test_key_list(self):
+        collector = StatsCollector()
+        manager = InMemoryObjectManager(range(95), cursors=False)
+        paginator = UnifiedPaginator(manager, 10, key_list_timeout=60, observer=collector)
+
+        #The first page reads the keys once
+        self.assertEqual(range(10), paginator.page(1).object_list)
+        self.assertEqual(95, manager.keys_fetched)
+        self.assertEqual(95, paginator._get_final_item())
+
+        #Deep pages are read by key instead of with an offset
+        page9 = paginator.page(9)
+        self.assertEqual(range(80, 90), page9.object_list)
+        stats = collector.stats[manager.cache_key][-1]
+        self.assertEqual(1, stats.queries)
+        self.assertEqual(10, stats.rows_fetched)
+        self.assertFalse(paginator.page(10).has_next())
+
+    def test_count(self):
+        manager = InMemoryObjectManager(range(95))
+        paginator = UnifiedPaginator(manager, 10, batch_size=2)
+        paginator.page(3)
+
+        #Neither queries nor starts a count
+        with mock.patch.object(paginator, "refresh_count") as mock_obj:
+            estimate = paginator.count_estimate()
+            self.assertFalse(mock_obj.called)
+        self.assertEqual((40, False), estimate[:2])
+
+        #count doesn't wait for the first count, it's started in the background
+        with mock.patch.object(paginator, "refresh_count") as mock_obj:
+            self.assertEqual(40, paginator.count)
+            mock_obj.assert_called_once_with(background=True)
+
+        #When no thread is free, the next request may start the count
+        with mock.patch.object(background_pool, "try_submit", return_value=None):
+            self.assertEqual(None, paginator.refresh_count(background=True))
+        self.assertEqual(None, cache.get(paginator._make_key("COUNTING")))
+
+        paginator.ensure_count().wait()
+        self.assertEqual((95, True), paginator.count_estimate()[:2])
+        self.assertEqual(95, paginator.count)
+        self.assertEqual(10, paginator.num_pages)
+        self.assertEqual(None, paginator.ensure_count())
+
+        #Only the objects after the highest cached cursor are counted again
+        for i in xrange(95, 120):
+            manager.add(i)
+        keys_fetched = manager.keys_fetched
+        self.assertEqual(120, paginator.refresh_count())
+        self.assertEqual(80, manager.keys_fetched - keys_fetched)
+
+    def test_prefetch_lease(self):
+        paginator = UnifiedPaginator(InMemoryObjectManager(range(50)), 5, batch_cache_timeout=60, prefetch_distance=1)
+
+        #A prefetch that couldn't be started doesn't keep other requests from trying
+        with mock.patch.object(paginator.object_list, "fetch_async", return_value=None):
+            paginator.page(1)
+        self.assertEqual(None, cache.get(paginator._make_key("PREFETCH_" + paginator._batch_suffix(1))))
+
+        paginator.page(1)
+        self.assertEqual(1, len(paginator._prefetches))
+        for future, key in paginator._prefetches:
+            future.wait()
+
+    def test_local_cache(self):
+        collector = StatsCollector()
+        manager = InMemoryObjectManager(range(95))
+        paginator = UnifiedPaginator(manager, 10, local_cache_timeout=5, observer=collector)
+        paginator.page(1)
+        paginator.page(2)
+
+        with mock.patch("potatopage.paginator.cache", wraps=cache) as mock_cache:
+            paginator.page(3)
+            #Only the metadata, the generation (and the count, which was never cached) are read
+            #from the shared cache
+            self.assertItemsEqual(
+                [
+                    "in_memory_%d|METADATA_LAST_PAGE" % id(manager),
+                    "in_memory_%d|METADATA_LAST_ITEM" % id(manager),
+                    "in_memory_%d|METADATA_END_CURSOR" % id(manager),
+                    "in_memory_%d|METADATA_KNOWN_PAGE_MAX" % id(manager),
+                    "in_memory_%d|METADATA_KNOWN_ITEMS_MAX" % id(manager),
+                    "in_memory_%d|COUNT" % id(manager),
+                    "in_memory_%d|GENERATION" % id(manager)
+                ],
+                mock_cache.get_many.call_args[0][0]
+            )
+        #The cursor of the page
+        self.assertEqual(1, collector.stats[manager.cache_key][-1].local_cache_hits)
+
+        #Another process finding the end isn't undone by the local copy of the metadata
+        other_paginator = UnifiedPaginator(manager, 10)
+        other_paginator.page(10)
+        paginator.page(4)
+        other_paginator._load_metadata()
+        self.assertEqual(10, other_paginator._get_final_page())
+        self.assertEqual(95, other_paginator._get_final_item())
+        self.assertEqual(10, other_paginator._get_known_page_count())
+
+        #Flushing still invalidates what is cached locally
+        paginator.flush_cache()
+        self.assertFalse(paginator.has_cursor_for_page(3))
+
+        #Every request gets a copy of its own
+        value = {"objects": [1]}
+        local_cache.set_many({"local": value}, 5)
+        value["objects"].append(2)
+        local_value = local_cache.get_many(["local"])["local"]
+        local_value["objects"].append(3)
+        self.assertEqual({"objects": [1]}, local_cache.get_many(["local"])["local"])
+
+    def test_watch_doesnt_keep_paginators_alive(self):
+        with mock.patch.object(InMemoryObjectManager, "model_cache_key", "watched_list"):
+            paginator = UnifiedPaginator(InMemoryObjectManager(range(10)), 5, track_changes=True)
+            invalidation.watch(paginator)
+            self.assertTrue(invalidation.is_watched("watched_list"))
+
+            del paginator
+            gc.collect()
+            self.assertFalse(invalidation.is_watched("watched_list"))
+
+    def test_object_changed(self):
+        manager = InMemoryObjectManager(range(0, 100, 2))
+        paginator = UnifiedPaginator(manager, 5, batch_size=2, track_changes=True)
+        for i in xrange(1, 11):
+            paginator.page(i)
+
+        #Adding an object near the end only drops the cursors after it
+        manager.add(91)
+        paginator.object_changed(None, manager.sort_key(91))
+        self.assertTrue(paginator.has_cursor_for_page(9))
+        self.assertFalse(paginator.has_cursor_for_page(11))
+        self.assertEqual(51, paginator.count)
+        self.assertEqual([98], paginator.page(11).object_list)
+
+        #Moving an object keeps the cursors outside the range it moved in
+        paginator.page(11)
+        manager.remove(50)
+        manager.add(51)
+        paginator.object_changed(manager.sort_key(50), manager.sort_key(51))
+        self.assertTrue(paginator.has_cursor_for_page(7))
+        self.assertEqual([51, 52, 54, 56, 58], paginator.page(6).object_list)
+
+        #Without track_changes everything is flushed
+        paginator = UnifiedPaginator(manager, 5, batch_size=2)
+        paginator.object_changed(manager.sort_key(2), None)
+        self.assertFalse(paginator.has_cursor_for_page(3))
+
+        #Objects appended after a short last page start on the right page
+        manager = InMemoryObjectManager(range(10, 80, 10))
+        paginator = UnifiedPaginator(manager, 5, batch_cache_timeout=60, track_changes=True)
+        paginator.page(1)
+        self.assertEqual([60, 70], paginator.page(2).object_list)
+        for i in xrange(80, 120, 10):
+            manager.add(i)
+            paginator.object_changed(None, manager.sort_key(i))
+            if i == 80:
+                self.assertEqual([60, 70, 80], paginator.page(2).object_list)
+        self.assertEqual([110], paginator.page(3).object_list)
+
+        #Deleting objects before the end was found moves it back
+        manager = InMemoryObjectManager(range(50))
+        paginator = UnifiedPaginator(manager, 5, readahead=False, track_changes=True)
+        with mock.patch.object(InMemoryObjectManager, "more_objects", None):
+            paginator.page(10)
+        for i in (48, 49):
+            manager.remove(i)
+            paginator.object_changed(manager.sort_key(i), None)
+        page10 = paginator.page(10)
+        self.assertEqual([45, 46, 47], page10.object_list)
+        self.assertFalse(page10.has_next())
+        self.assertEqual(10, paginator._get_known_page_count())
+
+    def test_page_async(self):
+        manager = InMemoryObjectManager(range(53))
+        paginator = UnifiedPaginator(manager, 5, batch_size=2, batch_cache_timeout=60)
+
+        #Both batch queries run at the same time
+        futures = [paginator.page_async(1), paginator.page_async(3)]
+        page1, page3 = [future.get_result() for future in futures]
+        self.assertEqual(range(5), page1.object_list)
+        self.assertEqual(range(10, 15), page3.object_list)
+        self.assertTrue(paginator.has_cursor_for_page(5))
+
+        #Pages of a cached batch are ready straight away
+        future = paginator.page_async(4)
+        self.assertTrue(future.done())
+        self.assertEqual(range(15, 20), future.get_result().object_list)
+
+        #The last page is the same as with page()
+        self.assertEqual(paginator.page(11).object_list, paginator.page_async(11).get_result().object_list)
+        self.assertFalse(paginator.page_async(11).get_result().has_next())
+
+        #With every background thread busy, get_result() does the work instead of waiting for one
+        with mock.patch.object(background_pool, "try_submit", return_value=None):
+            futures = [paginator.page_async(5), paginator.page_async(7)]
+            self.assertFalse(any(future.done() for future in futures))
+            self.assertEqual([range(20, 25), range(30, 35)], [future.get_result().object_list for future in futures])
+
+        #A page past the end, found in a background page(), is handed to the caller and
+        #isn't logged as a failure
+        with mock.patch("potatopage.utils.logging") as mock_logging:
+            future = UnifiedPaginator(InMemoryObjectManager(range(53)), 5, coalesce_timeout=5).page_async(20)
+            self.assertRaises(EmptyPage, future.get_result)
+        self.assertFalse(mock_logging.exception.called)
+
+    def test_get_pages(self):
+        managers = [InMemoryObjectManager(range(i, i + 50)) for i in xrange(3)]
+        paginators = [UnifiedPaginator(manager, 5) for manager in managers]
+        paginators[0].page(1)
+
+        with mock.patch("potatopage.paginator.cache", wraps=cache) as mock_cache:
+            pages = get_pages([(paginators[0], 2), (paginators[1], 1), (paginators[2], 10)])
+            #One cache read for all of them
+            self.assertEqual(1, mock_cache.get_many.call_count)
+
+        self.assertEqual(range(5, 10), pages[0].object_list)
+        self.assertEqual(range(1, 6), pages[1].object_list)
+        self.assertEqual(range(47, 52), pages[2].object_list)
+        self.assertRaises(EmptyPage, get_pages, [(paginators[0], 1), (paginators[1], 20)])
+
+    def test_page_snapshot(self):
+        manager = InMemoryObjectManager(range(95))
+        paginator = UnifiedPaginator(manager, 10, batch_size=2)
+        paginator.refresh_count()
+        page = paginator.page(3)
+        paginator.page(10)
+
+        #Renders from the counts it was served with, without the cache
+        with mock.patch("potatopage.paginator.cache") as mock_cache:
+            self.assertTrue(page.has_next())
+            self.assertEqual(30, page.end_index())
+            self.assertEqual([1, 2, 3, 4, 5], page.available_pages())
+            self.assertFalse(page.final_page_visible())
+            self.assertEqual((95, True), page.count_estimate()[:2])
+            self.assertFalse(mock_cache.method_calls)
+
+        with self.assertRaises(AttributeError):
+            page.snapshot.final_page = 10
+
+        #Serving a page starts the count its estimate needs, rendering doesn't
+        paginator = UnifiedPaginator(InMemoryObjectManager(range(95)), 10, batch_size=2)
+        paginator.count_on_page = True
+        with mock.patch.object(paginator, "refresh_count") as mock_obj:
+            page = paginator.page(1)
+            mock_obj.assert_called_once_with(background=True)
+            self.assertFalse(page.count_estimate().exact)
+            self.assertEqual(1, mock_obj.call_count)
+
+    def test_cursors_keep_their_position(self):
+        manager = InMemoryObjectManager(range(0, 20, 2))
+        manager[:3]
+        cursor = manager.next_cursor
+
+        #Objects added in front of the cursor don't move it
+        manager.add(1)
+        manager.add(5)
+        manager.starting_cursor(cursor)
+        self.assertEqual([5, 6, 8], manager[:3])
+
+
 class GaeNdbPaginationModel(ndb.Model):
     field1 = ndb.IntegerProperty()
 
@@ -173,7 +813,8 @@ class GaeNdbPaginatorTests(TestCase):
         paginator.page(3)
 
         self.assertFalse(paginator.has_cursor_for_page(2))
-        self.assertFalse(paginator.has_cursor_for_page(3))
+        #Stored while skipping ahead to the batch
+        self.assertTrue(paginator.has_cursor_for_page(3))
         self.assertTrue(paginator.has_cursor_for_page(5))
 
         paginator.page(1)
@@ -189,3 +830,70 @@ class GaeNdbPaginatorTests(TestCase):
 
         self.assertEqual(2, len(page3.object_list))
         self.assertEqual(10, page3.object_list[0].field1)
+
+    def test_page_cursors(self):
+        paginator = GaeNdbPaginator(GaeNdbPaginationModel.query().order(GaeNdbPaginationModel.field1), 5, batch_size=2, page_cursors=True)
+
+        paginator.page(1)
+        #The cursor for page 2 was read from the batch query of page 1
+        self.assertTrue(paginator.has_cursor_for_page(2))
+        self.assertTrue(paginator.has_cursor_for_page(3))
+
+        with mock.patch("potatopage.paginator.GaeNdbPaginator._process_batch_hook") as mock_obj:
+            #Should only read page 2, not the whole batch
+            page2 = paginator.page(2)
+            self.assertFalse(mock_obj.called)
+
+        self.assertEqual(5, len(page2.object_list))
+        self.assertEqual(5, page2.object_list[0].field1)
+        self.assertTrue(page2.has_next())
+
+    def test_fetch_async(self):
+        manager = GaeNdbPaginator(GaeNdbPaginationModel.query().order(GaeNdbPaginationModel.field1), 5).object_list
+
+        entities, cursor, more = manager.fetch_async(6).get_result()
+        self.assertEqual(range(6), [entity.field1 for entity in entities])
+        self.assertTrue(more)
+
+        #Ending exactly at the last entity is known to be the end
+        entities, cursor, more = manager.fetch_async(6, start_cursor=cursor).get_result()
+        self.assertEqual(range(6, 12), [entity.field1 for entity in entities])
+        self.assertFalse(more)
+
+    def test_flush_model_cache(self):
+        paginator = GaeNdbPaginator(GaeNdbPaginationModel.query().order(GaeNdbPaginationModel.field1), 5)
+        other_paginator = GaeNdbPaginator(GaeNdbPaginationModel.query().order(-GaeNdbPaginationModel.field1), 5)
+        paginator.page(2)
+        other_paginator.page(2)
+
+        flush_model_cache(GaeNdbPaginationModel)
+
+        self.assertFalse(paginator.has_cursor_for_page(3))
+        self.assertFalse(other_paginator.has_cursor_for_page(3))
+
+    def test_keys_only(self):
+        paginator = GaeNdbPaginator(
+            GaeNdbPaginationModel.query().order(GaeNdbPaginationModel.field1), 5,
+            batch_size=2, batch_cache_timeout=60, keys_only=True
+        )
+
+        with mock.patch("google.appengine.ext.ndb.get_multi", wraps=ndb.get_multi) as mock_get_multi:
+            page2 = paginator.page(2)
+            #Only the keys of the returned page are resolved
+            self.assertEqual(1, mock_get_multi.call_count)
+            self.assertEqual(5, len(mock_get_multi.call_args[0][0]))
+
+        self.assertEqual(range(5, 10), [entity.field1 for entity in page2.object_list])
+        self.assertTrue(page2.has_next())
+
+        #The batch cache holds the keys, page 1 loads its own entities
+        batch = cache.get(paginator._make_key(paginator._batch_suffix(0)))[1]
+        self.assertTrue(isinstance(batch[0], LazyEntityList))
+        page1 = paginator.page(1)
+        self.assertEqual(range(5), [entity.field1 for entity in page1.object_list])
+
+        #Slicing the manager itself doesn't load any entities
+        with mock.patch("google.appengine.ext.ndb.get_multi") as mock_get_multi:
+            batch = paginator.object_list[:10]
+            self.assertFalse(mock_get_multi.called)
+        self.assertEqual(10, len(batch))
@@ -1,6 +1,34 @@
+import hashlib
+import logging
+import re
+import threading
+
+from django.core.paginator import InvalidPage
 from django.db.models.sql.where import WhereNode
 
 
+def hashed_cache_key(prefix, *parts):
+    """
+        Builds a short, fixed length cache key out of a readable prefix (e.g.
+        the model name) and a digest of the given parts, so that big queries
+        stay well inside memcache's 250 byte key limit.
+    """
+    prefix = re.sub(r"[^\w]", "_", str(prefix))[:40]
+    return "%s_%s" % (prefix, hashlib.md5(repr(parts)).hexdigest())
+
+
+def model_cache_key(model):
+    """
+        Returns the part of the cache keys shared by all queries on a model.
+        Takes a Django model, an NDB model or a kind name.
+    """
+    if hasattr(model, "_meta"):
+        return model._meta.db_table
+    if hasattr(model, "_get_kind"):
+        return model._get_kind()
+    return str(model)
+
+
 def supports_cursor(queryset):
     #First, see if we are using one of Django's built-in connections
     #if we are then, return False
@@ -33,3 +61,145 @@ def supports_cursor(queryset):
     # It still might not support cursors, so we
     # check if the query doesn't have exclude filters or __in lookups
     return isnt_in_or_exclude_query(queryset)
+
+
+class Descending(object):
+    """
+        Wraps a value of a sort key so it compares the other way round, for
+        the descending parts of an ordering.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return "Descending(%r)" % (self.value,)
+
+
+class BackgroundFuture(object):
+    """
+        The result of a function run by a BackgroundPool. Has the parts of
+        ndb.Future's interface that we use, so both can be handled the same way.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._callbacks_done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self):
+        """ Waits for the result and for the callbacks to have run """
+        self._callbacks_done.wait()
+
+    def get_result(self):
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_callback(self, callback, *args, **kwargs):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append((callback, args, kwargs))
+                return
+        callback(*args, **kwargs)
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback, args, kwargs in callbacks:
+            callback(*args, **kwargs)
+        self._callbacks_done.set()
+
+
+class DeferredFuture(object):
+    """
+        A call which runs on the first thread that asks for its result, for
+        when no background thread is free. Has the same interface as
+        BackgroundFuture, apart from the callbacks.
+    """
+    def __init__(self, func, *args, **kwargs):
+        self._call = (func, args, kwargs)
+        self._lock = threading.Lock()
+        self._future = None
+
+    def done(self):
+        return self._future is not None
+
+    def wait(self):
+        with self._lock:
+            if self._future is None:
+                func, args, kwargs = self._call
+                self._future = BackgroundFuture()
+                try:
+                    self._future._finish(result=func(*args, **kwargs))
+                except Exception as e:
+                    self._future._finish(exception=e)
+
+    def get_result(self):
+        self.wait()
+        return self._future.get_result()
+
+
+class BackgroundPool(object):
+    """
+        Runs functions on background threads, never more than size at once.
+    """
+    def __init__(self, size):
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _run(self, future, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except InvalidPage as e:
+            # EmptyPage and PageNotAnInteger are answers for the caller, not failures
+            future._finish(exception=e)
+        except Exception as e:
+            logging.exception("Background call to %s failed" % func.__name__)
+            future._finish(exception=e)
+        else:
+            future._finish(result=result)
+        finally:
+            self._slots.release()
+
+    def submit(self, func, *args, **kwargs):
+        """ Runs func in the background, waiting for a free slot if needed """
+        self._slots.acquire()
+        return self._start(func, args, kwargs)
+
+    def try_submit(self, func, *args, **kwargs):
+        """ Like submit(), but returns None instead of waiting if all slots are busy """
+        if not self._slots.acquire(False):
+            return None
+        return self._start(func, args, kwargs)
+
+    def submit_or_defer(self, func, *args, **kwargs):
+        """
+            Like try_submit(), but if all slots are busy func runs once its
+            result is asked for (see DeferredFuture), instead of not at all.
+        """
+        return self.try_submit(func, *args, **kwargs) or DeferredFuture(func, *args, **kwargs)
+
+    def _start(self, func, args, kwargs):
+        future = BackgroundFuture()
+        thread = threading.Thread(target=self._run, args=(future, func, args, kwargs))
+        thread.daemon = True
+        thread.start()
+        return future
+
+
+background_pool = BackgroundPool(4)
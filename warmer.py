@@ -0,0 +1,82 @@
+"""
+    Walks a paginator's query with keys only queries ahead of time and caches
+    the cursor of every batch boundary, so deep links are fast even if nobody
+    paged through the listing in order. Usable from a task queue:
+
+        from potatopage.warmer import warm_cursors
+        result = warm_cursors(paginator, max_batches=500, rate_limit=5)
+        if not result["complete"]:
+            # Run again (e.g. re-enqueue the task), it continues where it stopped
+            ...
+
+    or as the warm_cursors management command.
+"""
+import time
+
+
+def _throttle(rate_limit, last_query):
+    """ Sleeps long enough to keep to rate_limit queries per second """
+    if rate_limit and last_query is not None:
+        delay = 1.0 / rate_limit - (time.time() - last_query)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def warm_cursors(paginator, max_batches=None, rate_limit=None, tail_only=False, batches_per_query=20):
+    """
+        Caches the cursor of every batch boundary of the paginator's query,
+        and the final page and item once the end is reached, in the same
+        cache entries page() reads.
+
+        max_batches - Stop after this many batch boundaries. The next run
+        continues from where this one stopped.
+
+        rate_limit - The maximum number of queries per second.
+
+        tail_only - Only walk from the last known end of the query, for lists
+        which mostly get objects appended.
+
+        batches_per_query - How many batch boundaries each walk goes over.
+        A walk is a single keys only query where the backend can read cursors
+        in the middle of a query (NDB), one query per boundary otherwise.
+
+        Returns a dict with the number of batches walked, the queries made and
+        whether the end of the query was reached ("complete").
+    """
+    manager = paginator.object_list
+    if not manager.supports_cursors:
+        raise ValueError("%s can't produce cursors to warm" % manager.__class__.__name__)
+
+    step = paginator.batch_items
+    # Continues from the highest cursor that is actually still cached
+    page, cursor = paginator.warm_start(tail_only)
+
+    result = {"batches": 0, "queries": 0, "complete": False}
+    last_query = None
+    while max_batches is None or result["batches"] < max_batches:
+        count = batches_per_query
+        if max_batches is not None:
+            count = min(count, max_batches - result["batches"])
+
+        _throttle(rate_limit, last_query)
+        last_query = time.time()
+        cursors = manager.cursors_ahead(step, count, start_cursor=cursor)
+        result["queries"] += manager.cursors_ahead_queries(count, len(cursors))
+        if cursors:
+            cursor = cursors[-1]
+
+        remaining = None
+        if len(cursors) < count:
+            # Past the last boundary, count the keys that are left
+            _throttle(rate_limit, last_query)
+            last_query = time.time()
+            remaining = manager.count_from(cursor, limit=step)
+            result["queries"] += 1
+
+        page = paginator.store_warmed_cursors(page, cursors, remaining)
+        result["batches"] += len(cursors)
+        if remaining is not None:
+            result["complete"] = True
+            break
+
+    return result